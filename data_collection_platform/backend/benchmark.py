@@ -0,0 +1,278 @@
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import logging
+
+import numpy as np
+import pylsl
+
+from pathlib import Path
+
+from constants import *
+from backend.storage import STORAGE_BACKENDS
+from backend.csv_data_recorder import CSVDataRecorder
+from backend.discovery import StreamQuery
+from backend.epoching import load_session_columns
+from backend.marker_outlet import MarkerOutlet
+
+logger = logging.getLogger(__name__)
+
+COUNTER_MODULUS = 2**24
+"""Channel 0 of the synthetic stream counts samples modulo this, the largest count float32 holds exactly
+"""
+
+PUSH_INTERVAL = 0.002
+"""Seconds between chunk pushes of the synthetic EEG outlet
+"""
+
+RESOLVE_TIMEOUT = 5.0
+"""Seconds to wait for the synthetic streams to be resolved
+"""
+
+
+class SyntheticEEGOutlet:
+    """Pushes a synthetic EEG stream at a fixed rate from a background thread.
+
+    Channel 0 carries a sample counter (modulo COUNTER_MODULUS), so dropped
+    and duplicated samples can be counted from the recorded session. The
+    other channels carry noise. Samples are pushed in small chunks, paced
+    against local_clock, so the stream keeps up with its nominal rate.
+    """
+
+    def __init__(self, rate, channels):
+        self.rate = rate
+        self.channels = channels
+        self.source_id = f"benchmark-eeg-{uuid.uuid4()}"
+        info = pylsl.StreamInfo(
+            "Benchmark EEG", "EEG", channels, rate, "float32", self.source_id
+        )
+        self.outlet = pylsl.StreamOutlet(info)
+        self.samples_pushed = 0
+        self.cpu_time = 0.0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._push_worker, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def _push_worker(self):
+        rng = np.random.default_rng(0)
+        noise = rng.normal(size=(int(self.rate) + 1, self.channels)).astype(np.float32)
+        cpu_start = time.thread_time()
+        t0 = pylsl.local_clock()
+
+        while self.running:
+            target = int((pylsl.local_clock() - t0) * self.rate)
+            n = target - self.samples_pushed
+            if n > 0:
+                chunk = noise[np.arange(n) % len(noise)]
+                chunk[:, 0] = (np.arange(self.samples_pushed, target) % COUNTER_MODULUS)
+                self.outlet.push_chunk(chunk)
+                self.samples_pushed = target
+            time.sleep(PUSH_INTERVAL)
+
+        self.cpu_time = time.thread_time() - cpu_start
+
+
+def count_lost_samples(counter: np.ndarray):
+    """Count the dropped and duplicated samples in a recorded sample counter.
+
+    Args:
+        counter (np.ndarray): Recorded channel 0 of a SyntheticEEGOutlet stream.
+
+    Returns:
+        tuple: Number of dropped samples and number of duplicated or out of order samples.
+    """
+    steps = np.diff(counter.astype(np.int64)) % COUNTER_MODULUS
+    dropped = int(np.sum(steps[steps > 1] - 1))
+    duplicated = int(np.sum(steps == 0) + np.sum(steps > COUNTER_MODULUS // 2))
+    return dropped, duplicated
+
+
+def run_benchmark(
+    rate=125,
+    channels=16,
+    duration=10.0,
+    chunked=True,
+    storage_backend="npy",
+    marker_interval=0.5,
+    poll_interval=0.1,
+):
+    """Record a synthetic EEG stream and a marker stream with CSVDataRecorder and measure it.
+
+    Both outlets run in this process. Markers are sent with MarkerOutlet.send
+    like the data collection platform does, alternating between an image
+    with STATUS_IMAGINE and STATUS_TRANSITION. The session is written to a
+    temporary directory, read back to count dropped and duplicated samples,
+    and deleted.
+
+    Args:
+        rate (float, optional): Nominal rate of the EEG stream in Hz. Defaults to 125.
+        channels (int, optional): Number of EEG channels. Defaults to 16.
+        duration (float, optional): Seconds to record. Defaults to 10.
+        chunked (bool, optional): Record in chunked mode. Defaults to True.
+        storage_backend (str, optional): Key in STORAGE_BACKENDS. Defaults to "npy".
+        marker_interval (float, optional): Seconds between markers. Defaults to 0.5.
+        poll_interval (float, optional): Seconds between writer queue depth samples. Defaults to 0.1.
+
+    Returns:
+        dict: Benchmark parameters and results.
+    """
+    eeg_outlet = SyntheticEEGOutlet(rate, channels)
+    marker_outlet = MarkerOutlet()
+
+    recorder = CSVDataRecorder(
+        find_streams=False,
+        eeg_query=StreamQuery("EEG", source_id=eeg_outlet.source_id),
+        marker_query=StreamQuery(
+            "Markers", source_id=marker_outlet.outlet.get_info().source_id()
+        ),
+    )
+    recorder.find_streams(timeout=RESOLVE_TIMEOUT)
+
+    data_dir = Path(tempfile.mkdtemp(prefix="recorder_benchmark_"))
+    filename = "benchmark.csv"
+
+    cpu_start = time.process_time()
+    eeg_outlet.start()
+    try:
+        queue_depths = []
+        markers_sent = 0
+        recorder_start = time.perf_counter()
+        recorder.start(
+            filename,
+            chunked=chunked,
+            storage=storage_backend,
+            journal_interval=None,
+            data_dir=data_dir,
+        )
+
+        next_marker = time.perf_counter()
+        while time.perf_counter() - recorder_start < duration:
+            if time.perf_counter() >= next_marker:
+                if markers_sent % 2 == 0:
+                    marker_outlet.send(
+                        new_image=(markers_sent // 2) % recorder.num_imgs,
+                        new_status=STATUS_IMAGINE,
+                    )
+                else:
+                    marker_outlet.send_transition(STATUS_TRANSITION)
+                markers_sent += 1
+                next_marker += marker_interval
+            queue_depths.append(recorder.get_writer_stats()["queue_depth"])
+            time.sleep(poll_interval)
+
+        recorder.stop()
+        wall_time = time.perf_counter() - recorder_start
+        cpu_time = time.process_time() - cpu_start
+    finally:
+        recorder.eeg_inlet.close_stream()
+        recorder.marker_inlet.close_stream()
+        eeg_outlet.stop()
+
+    try:
+        columns = load_session_columns(_session_path(data_dir, filename, storage_backend))
+        counter = np.asarray(columns["channels"][:, 0])
+        status_changes = int(np.count_nonzero(np.diff(columns["status"])))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    dropped, duplicated = count_lost_samples(counter)
+    stats = recorder.get_writer_stats()
+    # The synthetic outlet runs in this process, its thread's CPU time is not the recorder's
+    cpu_time -= eeg_outlet.cpu_time
+
+    return {
+        "rate": rate,
+        "channels": channels,
+        "duration": duration,
+        "chunked": chunked,
+        "storage": storage_backend,
+        "samples_recorded": len(counter),
+        "samples_per_second": len(counter) / wall_time,
+        "dropped_samples": dropped,
+        "duplicated_samples": duplicated,
+        "markers_sent": markers_sent,
+        "status_changes_recorded": status_changes,
+        "max_sample_lag": stats["max_sample_lag"],
+        "max_queue_lag": stats["max_lag"],
+        "max_queue_depth": max(queue_depths, default=0),
+        "queue_high_water": stats["queue_high_water"],
+        "writer_stalls": stats["stalls"],
+        "writer_dropped_samples": stats["dropped_samples"],
+        "cpu_percent": 100 * cpu_time / wall_time,
+        "metrics": recorder.get_metrics(),
+    }
+
+
+def _session_path(data_dir, filename, storage_backend):
+    stem = Path(filename).stem
+    if storage_backend == "npy":
+        return data_dir / stem
+    if storage_backend == "eegz":
+        return data_dir / f"{stem}.eegz"
+    return data_dir / filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure CSVDataRecorder throughput and sample loss against local synthetic LSL streams."
+    )
+    parser.add_argument("--rates", type=float, nargs="+", default=[125, 1000, 8000])
+    parser.add_argument("--channels", type=int, nargs="+", default=[16])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument(
+        "--storage", default="npy", choices=list(STORAGE_BACKENDS)
+    )
+    parser.add_argument(
+        "--unchunked", action="store_true", help="Record with one pull_sample per sample."
+    )
+    parser.add_argument("--json", action="store_true", help="Print one JSON result per line.")
+    parser.add_argument(
+        "--fail-on-loss",
+        action="store_true",
+        help="Exit with status 1 if any run dropped or duplicated samples.",
+    )
+    args = parser.parse_args()
+
+    lossy = False
+    for channels in args.channels:
+        for rate in args.rates:
+            result = run_benchmark(
+                rate=rate,
+                channels=channels,
+                duration=args.duration,
+                chunked=not args.unchunked,
+                storage_backend=args.storage,
+            )
+            lossy |= bool(
+                result["dropped_samples"]
+                or result["duplicated_samples"]
+                or result["writer_dropped_samples"]
+            )
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(
+                    f"{rate:>8.0f} Hz x {channels:>3} ch: "
+                    f"{result['samples_per_second']:>9.0f} samples/s, "
+                    f"dropped {result['dropped_samples']}, "
+                    f"duplicated {result['duplicated_samples']}, "
+                    f"sample lag {result['max_sample_lag'] * 1000:.1f} ms, "
+                    f"queue depth {result['max_queue_depth']} "
+                    f"(high water {result['queue_high_water']}), "
+                    f"cpu {result['cpu_percent']:.0f}%"
+                )
+
+    sys.exit(1 if args.fail_on_loss and lossy else 0)
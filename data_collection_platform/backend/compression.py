@@ -0,0 +1,216 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from constants import *
+
+MAGIC = b"EEGZ\x01"
+"""First bytes of a compressed session file, including the format version
+"""
+
+COMPRESSION_LEVEL = 1
+"""zlib level used for every section. Level 1 keeps up with real-time ingestion on one core
+"""
+
+RECORD_HEADER = struct.Struct("<cI")
+"""Record header: record type, payload size in bytes
+"""
+
+BLOCK_HEADER = struct.Struct("<IIB")
+"""Data block header: number of samples, number of markers, bytes per channel value (4 or 8)
+"""
+
+SECTION_HEADER = struct.Struct("<I")
+"""Compressed size of one section of a data block
+"""
+
+RECORD_BLOCK = b"B"
+"""Record holding one encoded block of samples and markers
+"""
+
+RECORD_PAUSES = b"P"
+"""Record holding float64 (pauses x 2) paused_at and resumed_at timestamps
+"""
+
+RECORD_CLOCK_OFFSETS = b"C"
+"""Record holding float64 (captures x 3) local_time, eeg_offset and marker_offset
+"""
+
+
+def _shuffle(values: np.ndarray) -> bytes:
+    """Group the i-th byte of every value together, which makes numeric data far more compressible."""
+    values = np.ascontiguousarray(values)
+    return values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+
+
+def _unshuffle(data: bytes, dtype) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(-1)
+
+
+def _delta(values: np.ndarray) -> np.ndarray:
+    """Exact int64 delta of the bit patterns of values, so the encoding stays lossless."""
+    bits = np.ascontiguousarray(values).view(np.int64)
+    return np.diff(bits, prepend=np.int64(0))
+
+
+def _undelta(deltas: np.ndarray, dtype) -> np.ndarray:
+    return np.cumsum(deltas, dtype=np.int64).view(dtype)
+
+
+def _compress(values: np.ndarray) -> bytes:
+    data = zlib.compress(_shuffle(values), COMPRESSION_LEVEL)
+    return SECTION_HEADER.pack(len(data)) + data
+
+
+def encode_block(
+    eeg_block: np.ndarray,
+    marker_block: np.ndarray,
+    status: np.ndarray,
+    image_id: np.ndarray,
+) -> bytes:
+    """Losslessly encode one block of a session.
+
+    Timestamps are delta encoded on their float64 bit patterns, status and
+    image_id are delta encoded as integers, and each channel is compressed
+    on its own after byte shuffling. Channels are stored as float32 when that
+    is exact (e.g. OpenBCI streams), float64 otherwise.
+
+    Args:
+        eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+        marker_block (np.ndarray): (markers x 5) array, timestamp first.
+        status (np.ndarray): Status of every sample.
+        image_id (np.ndarray): Image id of every sample.
+
+    Returns:
+        bytes: Payload of a RECORD_BLOCK record.
+    """
+    channels = eeg_block[:, 1:]
+    channels32 = channels.astype(np.float32)
+    if np.array_equal(channels32, channels, equal_nan=True):
+        channels = channels32
+
+    sections = [
+        BLOCK_HEADER.pack(len(eeg_block), len(marker_block), channels.itemsize),
+        _compress(_delta(eeg_block[:, 0].astype(np.float64))),
+    ]
+    sections += [_compress(channels[:, i]) for i in range(channels.shape[1])]
+    sections += [
+        _compress(np.diff(status.astype(np.int32), prepend=np.int32(0))),
+        _compress(np.diff(image_id.astype(np.int32), prepend=np.int32(0))),
+        _compress(marker_block.astype(np.float64)),
+    ]
+    return b"".join(sections)
+
+
+def decode_block(payload: bytes, num_channels) -> dict:
+    """Decode a block encoded by encode_block.
+
+    Returns:
+        dict: timestamps (float64), channels (samples x channels), status and image_id
+            (int32), and markers (markers x 5 float64, timestamp first).
+    """
+    num_samples, num_markers, itemsize = BLOCK_HEADER.unpack_from(payload)
+    offset = BLOCK_HEADER.size
+
+    def section(dtype):
+        nonlocal offset
+        (size,) = SECTION_HEADER.unpack_from(payload, offset)
+        offset += SECTION_HEADER.size
+        values = _unshuffle(zlib.decompress(payload[offset : offset + size]), dtype)
+        offset += size
+        return values
+
+    timestamps = _undelta(section(np.int64), np.float64)
+    channel_dtype = np.float32 if itemsize == 4 else np.float64
+    channels = np.empty((num_samples, num_channels), dtype=channel_dtype)
+    for i in range(num_channels):
+        channels[:, i] = section(channel_dtype)
+    status = np.cumsum(section(np.int32), dtype=np.int32)
+    image_id = np.cumsum(section(np.int32), dtype=np.int32)
+    markers = section(np.float64).reshape(num_markers, 1 + MARKER_CHANNELS)
+
+    return {
+        "timestamps": timestamps,
+        "channels": channels,
+        "status": status,
+        "image_id": image_id,
+        "markers": markers,
+    }
+
+
+def write_file_header(file, metadata: dict):
+    data = json.dumps(metadata).encode("utf-8")
+    file.write(MAGIC + struct.pack("<I", len(data)) + data)
+
+
+def write_record(file, record_type, payload: bytes):
+    file.write(RECORD_HEADER.pack(record_type, len(payload)) + payload)
+
+
+def _read_records(file):
+    while True:
+        header = file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        record_type, size = RECORD_HEADER.unpack(header)
+        payload = file.read(size)
+        if len(payload) < size:
+            return
+        yield record_type, payload
+
+
+def read_metadata(path) -> dict:
+    """Return the metadata (channel names, num_imgs) stored at the start of a compressed session."""
+    with open(path, "rb") as f:
+        return _read_file_header(f)
+
+
+def _read_file_header(file) -> dict:
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{file.name} is not a compressed session")
+    (size,) = struct.unpack("<I", file.read(4))
+    return json.loads(file.read(size))
+
+
+def iter_blocks(path):
+    """Decode a compressed session block by block, in constant memory.
+
+    Args:
+        path (str or Path): Path to a .eegz file.
+
+    Yields:
+        dict: One decoded block, see decode_block.
+    """
+    with open(path, "rb") as f:
+        num_channels = len(_read_file_header(f)["channels"])
+        for record_type, payload in _read_records(f):
+            if record_type == RECORD_BLOCK:
+                yield decode_block(payload, num_channels)
+
+
+def _read_trailer(path, record_type, width) -> np.ndarray:
+    """Return the float64 (rows x width) payload of the first record of a type, skipping the blocks."""
+    with open(path, "rb") as f:
+        _read_file_header(f)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return np.empty((0, width))
+            current_type, size = RECORD_HEADER.unpack(header)
+            if current_type == record_type:
+                return np.frombuffer(f.read(size), dtype=np.float64).reshape(-1, width)
+            f.seek(size, 1)
+
+
+def read_pauses(path) -> np.ndarray:
+    """Return the (pauses x 2) paused_at and resumed_at timestamps of a compressed session."""
+    return _read_trailer(path, RECORD_PAUSES, 2)
+
+
+def read_clock_offsets(path) -> np.ndarray:
+    """Return the (captures x 3) local_time, eeg_offset and marker_offset of a compressed session."""
+    return _read_trailer(path, RECORD_CLOCK_OFFSETS, 3)
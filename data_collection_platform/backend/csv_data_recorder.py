@@ -1,16 +1,27 @@
 import pylsl
 import os
+import queue
 import time
 import threading
 
 import pandas as pd
 import numpy as np
-import typing
 import logging
 
 from pathlib import Path
 
 from constants import *
+from backend.merging import StreamingMerger, add_label_columns, forward_fill_markers
+from backend.storage import DATA_DIR, STORAGE_BACKENDS
+from backend.journal import Journal, JOURNAL_SYNC_INTERVAL
+from backend.metrics import RecorderMetrics
+from backend.marker_outlet import MARKER_SOURCE_ID
+from backend.discovery import (
+    DISCOVERY_TIMEOUT,
+    StreamQuery,
+    find_streams,
+    open_inlets,
+)
 
 
 # sys.path.append(os.path.join(os.path.dirname(__file__), '../../..'))
@@ -20,32 +31,170 @@ from constants import *
 # # https://github.com/NTX-McGill/NeuroTechX-McGill-2021/blob/main/software/backend/dcp/bci/stream.py
 logger = logging.getLogger(__name__)
 
+EEG_BUFFER_SIZE = 16384
+"""Number of EEG samples held in memory before a block is flushed to disk
+"""
 
-def find_bci_inlet(debug=False):
-    """Find an EEG stream and return an inlet to it.
+MARKER_BUFFER_SIZE = 1024
+"""Number of markers held in memory before a block is flushed to disk
+"""
+
+PULL_TIMEOUT = 1.0
+"""Seconds pull_sample waits for an EEG sample, so the worker notices stop() if the stream stalls
+"""
+
+WRITER_QUEUE_SIZE = 8
+"""Number of blocks that can wait for the writer thread before the worker blocks
+"""
+
+WRITER_PUT_TIMEOUT = 30.0
+"""Seconds the worker blocks on a full writer queue before the block is dropped
+"""
+
+DEFAULT_MAX_CHUNK_SIZE = 1024
+"""Maximum number of EEG samples pulled per pull_chunk call in chunked mode
+"""
+
+DEFAULT_CHUNK_TIMEOUT = 0.2
+"""Seconds a pull_chunk call waits for a chunk to fill in chunked mode
+"""
+
+CLOCK_OFFSET_INTERVAL = 5.0
+"""Seconds between two captures of the time_correction() offsets of both inlets
+"""
+
+TIME_CORRECTION_TIMEOUT = 0.0
+"""Seconds a time_correction() call may block the worker. liblsl measures the offsets in the
+background, so a capture that times out is retried on the next pull instead
+"""
+
+LSL_DTYPES = {
+    pylsl.cf_float32: np.float32,
+    pylsl.cf_double64: np.float64,
+    pylsl.cf_int32: np.int32,
+    pylsl.cf_int16: np.int16,
+    pylsl.cf_int8: np.int8,
+    pylsl.cf_int64: np.int64,
+}
+"""Numpy dtype matching each LSL channel format, used for pull_chunk destination buffers
+"""
+
+
+def open_inlet(info: pylsl.StreamInfo, clocksync=True):
+    """Open a dejittered inlet to a resolved stream.
+
+    Inlets must be opened from the StreamInfo returned by a resolve function,
+    as the full info of an open inlet does not hold the stream's address.
+
+    Args:
+        info (pylsl.StreamInfo): Resolved stream info.
+        clocksync (bool, optional): Map the stream's timestamps to the local clock
+            (proc_clocksync). Defaults to True.
+
+    Returns:
+        pylsl.StreamInlet: Inlet to the stream
+    """
+    flags = pylsl.proc_dejitter | (pylsl.proc_clocksync if clocksync else pylsl.proc_none)
+    return pylsl.StreamInlet(info, processing_flags=flags)
+
+
+def find_bci_stream(debug=False, name=None, source_id=None, timeout=DISCOVERY_TIMEOUT):
+    """Find an EEG stream and return its info.
 
     Args:
         debug (bool, optional): Print extra info. Defaults to False.
+        name (str, optional): Only accept a stream with this name.
+        source_id (str, optional): Only accept a stream with this source id.
+        timeout (float, optional): Seconds to wait for the stream. Defaults to DISCOVERY_TIMEOUT.
+
+    Raises:
+        StreamNotFoundError: If no matching stream is found within timeout seconds.
 
     Returns:
-        pylsl.StreamInlet: Inlet to the EEG stream
+        pylsl.StreamInfo: Resolved info of the EEG stream
     """
 
     logger.info("Looking for an EEG stream...")
-    streams = pylsl.resolve_stream("type", "EEG")
-    # Block until stream found
-    inlet = pylsl.StreamInlet(
-        streams[0], processing_flags=pylsl.proc_dejitter | pylsl.proc_clocksync
-    )
+    info = find_streams({"eeg": StreamQuery("EEG", name, source_id)}, timeout)["eeg"]
 
     logger.info(
-        f"Connected to stream: {streams[0].name()}, Stream channel_count: {streams[0].channel_count()}"
+        f"Connected to stream: {info.name()}, Stream channel_count: {info.channel_count()}"
     )
 
     if debug:
-        logger.info(f"Stream info dump:\n{streams[0].as_xml()}")
+        logger.info(f"Stream info dump:\n{info.as_xml()}")
+
+    return info
+
+
+def find_bci_inlet(debug=False):
+    """Find an EEG stream and return an inlet to it.
+
+    Args:
+        debug (bool, optional): Print extra info. Defaults to False.
+
+    Returns:
+        pylsl.StreamInlet: Inlet to the EEG stream
+    """
+    return open_inlet(find_bci_stream(debug))
+
+
+def get_channel_names(info: pylsl.StreamInfo):
+    """Return the channel labels of an EEG stream.
+
+    Uses the labels in the stream's <channels> description if every channel has
+    a unique one, otherwise falls back to ch1..chN.
+
+    Args:
+        info (pylsl.StreamInfo): Full stream info, e.g. from StreamInlet.info().
+
+    Returns:
+        list: One column name per channel.
+    """
+    labels = []
+    channel = info.desc().child("channels").child("channel")
+    while not channel.empty():
+        labels.append(channel.child_value("label"))
+        channel = channel.next_sibling("channel")
+
+    if (
+        len(labels) == info.channel_count()
+        and all(labels)
+        and len(set(labels)) == len(labels)
+        and "timestamp" not in labels
+    ):
+        return labels
+    return [f"ch{i+1}" for i in range(info.channel_count())]
+
+
+def find_marker_stream(
+    debug=False, name=None, source_id=MARKER_SOURCE_ID, timeout=DISCOVERY_TIMEOUT
+):
+    """Find a marker stream and return its info.
+
+    Args:
+        debug (bool, optional): Print extra info. Defaults to False.
+        name (str, optional): Only accept a stream with this name.
+        source_id (str, optional): Only accept a stream with this source id. Defaults to
+            the MarkerOutlet stream, None accepts any marker stream.
+        timeout (float, optional): Seconds to wait for the stream. Defaults to DISCOVERY_TIMEOUT.
+
+    Raises:
+        StreamNotFoundError: If no matching stream is found within timeout seconds.
+
+    Returns:
+        pylsl.StreamInfo: Resolved info of the marker stream
+    """
+
+    logger.info("Looking for a marker stream...")
+    info = find_streams({"marker": StreamQuery("Markers", name, source_id)}, timeout)["marker"]
+
+    logger.info(f"Connected to stream: {info.name()}")
+
+    if debug:
+        logger.info(f"Stream info dump:\n{info.as_xml()}")
 
-    return inlet
+    return info
 
 
 def find_marker_inlet(debug=False):
@@ -57,62 +206,211 @@ def find_marker_inlet(debug=False):
     Returns:
         pylsl.StreamInlet: Inlet to the marker stream
     """
+    return open_inlet(find_marker_stream(debug))
 
-    logger.info("Looking for a marker stream...")
-    streams = pylsl.resolve_stream("type", "Markers")
-    # Block until stream found
-    inlet = pylsl.StreamInlet(
-        streams[0], processing_flags=pylsl.proc_dejitter | pylsl.proc_clocksync
-    )
 
-    logger.info(f"Found {len(streams)} streams")
-    logger.info(f"Connected to stream: {streams[0].name()}")
+def get_csv_channel_names(eeg_df: pd.DataFrame):
+    """Return the channel columns of an EEG frame, i.e. every column except timestamp."""
+    return [c for c in eeg_df.columns if c != "timestamp"]
 
-    if debug:
-        logger.info(f"Stream info dump:\n{streams[0].as_xml()}")
 
-    return inlet
+class SampleBuffer:
+    """Fixed-capacity, preallocated (samples x 1 + channels) buffer with a write cursor.
+
+    Column 0 holds the timestamp, the remaining columns hold the sample values.
+    Appending writes in place, so ingestion is O(1) per sample. take() hands
+    the filled rows off as a view and swaps in a fresh array, so the block
+    can be written out by another thread without being copied.
+    """
+
+    def __init__(self, capacity, channels, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        self.dtype = dtype
+        self.data = np.empty((capacity, 1 + channels), dtype=dtype)
+        self.size = 0
+        self.journaled = 0
+
+    def append(self, timestamp, sample):
+        """Write one timestamped sample at the cursor."""
+        self.data[self.size, 0] = timestamp
+        self.data[self.size, 1:] = sample
+        self.size += 1
+
+    def extend(self, timestamps, samples) -> int:
+        """Write as many timestamped samples as fit at the cursor.
+
+        Returns:
+            int: Number of samples written. Less than len(timestamps) if the buffer filled up.
+        """
+        n = min(len(timestamps), self.capacity - self.size)
+        self.data[self.size : self.size + n, 0] = timestamps[:n]
+        self.data[self.size : self.size + n, 1:] = samples[:n]
+        self.size += n
+        return n
+
+    def full(self):
+        return self.size >= self.capacity
+
+    def unjournaled(self) -> np.ndarray:
+        """Return a view of the rows written since the last call, for the journal."""
+        rows = self.data[self.journaled : self.size]
+        self.journaled = self.size
+        return rows
+
+    def take(self) -> np.ndarray:
+        """Return the filled rows and reset the buffer to a fresh array."""
+        block = self.data[: self.size]
+        self.data = np.empty((self.capacity, 1 + self.channels), dtype=self.dtype)
+        self.size = 0
+        self.journaled = 0
+        return block
 
 
 class CSVDataRecorder:
     """Class to record EEG and marker data to a CSV file."""
 
-    def __init__(self, find_streams=True, num_imgs=20):
-        self.eeg_inlet = find_bci_inlet() if find_streams else None
-        self.marker_inlet = find_marker_inlet() if find_streams else None
+    def __init__(
+        self, find_streams=True, num_imgs=20, eeg_query=None, marker_query=None
+    ):
+        """Create a recorder, optionally finding its streams right away.
+
+        Args:
+            find_streams (bool, optional): Call find_streams(). Defaults to True.
+            num_imgs (int, optional): Number of images of the one-hot image columns. Defaults to 20.
+            eeg_query (StreamQuery, optional): EEG stream to record. Defaults to the newest
+                stream of type EEG.
+            marker_query (StreamQuery, optional): Marker stream to record. Defaults to the
+                MarkerOutlet stream.
+
+        Raises:
+            StreamNotFoundError: If find_streams is set and a stream is not found.
+        """
+        self.eeg_query = eeg_query or StreamQuery("EEG")
+        self.marker_query = marker_query or StreamQuery("Markers", source_id=MARKER_SOURCE_ID)
+        self.eeg_info = None
+        self.marker_info = None
+        self.eeg_inlet = None
+        self.marker_inlet = None
+        self.channel_names = None
+        self.ready = False
 
         self.recording = False
         self.paused = False
-        self.ready = self.eeg_inlet is not None and self.marker_inlet is not None
-
-        if self.ready:
-            logger.info("Ready to start recording.")
+        self.paused_at = None
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.pauses = []
+        self.clock_offsets = []
+        self.clocksync = True
+        self.worker_thread = None
+        self.writer_thread = None
+        self.writer_queue = None
+        self.writer_stats = {}
+        self.metrics = None
+        self.metrics_path = None
+        self.storage = None
+        self.journal = None
 
         self.num_imgs = num_imgs
 
-    def find_streams(self):
-        """Find EEG and marker streams. Updates the ready flag."""
-        self.find_eeg_inlet()
-        self.find_marker_inlet()
-        self.ready = self.eeg_inlet is not None and self.marker_inlet is not None
+        if find_streams:
+            self.find_streams()
+
+    def find_streams(self, timeout=DISCOVERY_TIMEOUT):
+        """Find the EEG and marker streams together and connect to them. Updates the ready flag.
 
-    def find_eeg_inlet(self):
+        Streams found by an earlier call are reconnected to directly, without a
+        new discovery round, unless they no longer accept connections.
+
+        Args:
+            timeout (float, optional): Seconds to wait for the streams. Defaults to DISCOVERY_TIMEOUT.
+
+        Raises:
+            StreamNotFoundError: If a stream is not found within timeout seconds.
+        """
+        self.ready = False
+        opened = open_inlets(
+            {"eeg": self.eeg_query, "marker": self.marker_query},
+            self._open_inlet,
+            timeout,
+        )
+        self._set_eeg_inlet(*opened["eeg"])
+        self._set_marker_inlet(*opened["marker"])
+        self.ready = True
+        logger.info("Ready to start recording.")
+
+    def find_eeg_inlet(self, timeout=DISCOVERY_TIMEOUT):
         """Find the EEG stream and update the inlet."""
-        self.eeg_inlet = find_bci_inlet(debug=False)
-        logger.info(f"EEG Inlet found:{self.eeg_inlet}")
+        opened = open_inlets({"eeg": self.eeg_query}, self._open_inlet, timeout)
+        self._set_eeg_inlet(*opened["eeg"])
+
+        self.ready = self.eeg_inlet is not None and self.marker_inlet is not None
 
-    def find_marker_inlet(self):
+    def find_marker_inlet(self, timeout=DISCOVERY_TIMEOUT):
         """Find the marker stream and update the inlet."""
-        self.marker_inlet = find_marker_inlet(debug=False)
-        logger.info(f"Marker Inlet found:{self.marker_inlet}")
+        opened = open_inlets({"marker": self.marker_query}, self._open_inlet, timeout)
+        self._set_marker_inlet(*opened["marker"])
 
         self.ready = self.eeg_inlet is not None and self.marker_inlet is not None
 
-    def start(self, filename="test_data_0.csv"):
+    def _open_inlet(self, info):
+        return open_inlet(info, self.clocksync)
+
+    def _set_eeg_inlet(self, info, inlet):
+        self.eeg_info = info
+        self.eeg_inlet = inlet
+        self.channel_names = get_channel_names(self.eeg_inlet.info())
+        logger.info(f"EEG Inlet found:{self.eeg_inlet}")
+        logger.info(f"EEG channels: {self.channel_names}")
+
+    def _set_marker_inlet(self, info, inlet):
+        self.marker_info = info
+        self.marker_inlet = inlet
+        logger.info(f"Marker Inlet found:{self.marker_inlet}")
+
+    def start(
+        self,
+        filename="test_data_0.csv",
+        chunked=False,
+        max_chunk_size=DEFAULT_MAX_CHUNK_SIZE,
+        chunk_timeout=DEFAULT_CHUNK_TIMEOUT,
+        storage="csv",
+        journal_interval=JOURNAL_SYNC_INTERVAL,
+        data_dir=DATA_DIR,
+        clocksync=True,
+    ):
         """Start recording data to a CSV file. The recording will continue until stop() is called.
         The filename is the name of the file to save the data to. If the file already exists, it will be overwritten.
         If the LSL streams are not available, the function will print a message and return without starting the recording.
-        Note that the output file will only be written to disk when the recording is stopped.
+        Blocks are written to disk as they fill up, and the merged file is complete once stop() returns.
+
+        Args:
+            filename (str, optional): Name of the output file. Defaults to "test_data_0.csv".
+            chunked (bool, optional): Pull EEG with pull_chunk into a preallocated buffer instead of
+                one pull_sample per sample, and drain markers in bulk. Defaults to False.
+            max_chunk_size (int, optional): Maximum number of EEG samples pulled per chunk.
+            chunk_timeout (float, optional): Seconds to wait for a chunk to fill before returning
+                the samples available so far.
+            storage (str, optional): Storage backend from backend.storage.STORAGE_BACKENDS.
+                "csv" writes eeg_, markers_ and merged CSV files, "npy" writes a directory of
+                binary .npy columns, "eegz" writes one losslessly compressed file.
+                Defaults to "csv".
+            journal_interval (float, optional): Seconds between fsyncs of the crash recovery
+                journal in collected_data/<name>.journal. The journal is deleted when the
+                recording stops cleanly, and a session that did not stop cleanly can be rebuilt
+                from it with python -m backend.journal. None disables the journal.
+            data_dir (str or Path, optional): Directory the session is written to.
+                Defaults to collected_data. The timing metrics of the session (see
+                get_metrics()) are written to metrics_<name>.json in it when the
+                recording stops.
+            clocksync (bool, optional): Let liblsl map both streams to the local clock
+                (proc_clocksync). If False, the inlets record raw stream timestamps, and
+                markers are placed on the EEG timeline by interpolating the
+                time_correction() offsets of both inlets captured every
+                CLOCK_OFFSET_INTERVAL seconds. The merged output then holds corrected
+                timestamps, and eeg_/markers_ files keep the raw ones. The offsets
+                are saved with the session in both modes. Defaults to True.
         """
 
         if not self.ready:
@@ -122,271 +420,447 @@ class CSVDataRecorder:
             return
 
         self.recording = True
+        self.paused = False
+        self.paused_at = None
+        self.resume_event.set()
+        self.pauses = []
+        self.clock_offsets = []
+        self._open_inlets(clocksync)
+
+        self.storage = STORAGE_BACKENDS[storage](
+            filename,
+            self.channel_names,
+            num_imgs=self.num_imgs,
+            data_dir=data_dir,
+            clock_offsets=None if clocksync else self.clock_offsets,
+        )
+        self.journal = (
+            Journal(
+                filename,
+                self.channel_names,
+                self.num_imgs,
+                storage,
+                journal_interval,
+                data_dir=data_dir,
+                clocksync=clocksync,
+            )
+            if journal_interval is not None
+            else None
+        )
+        self.metrics = RecorderMetrics(self.eeg_inlet.info().nominal_srate())
+        self.metrics_path = Path(data_dir) / f"metrics_{Path(filename).stem}.json"
+        self.writer_queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.writer_stats = {
+            "blocks_written": 0,
+            "samples_written": 0,
+            "queue_high_water": 0,
+            "stalls": 0,
+            "stall_time": 0.0,
+            "dropped_blocks": 0,
+            "dropped_samples": 0,
+            "write_errors": 0,
+            "last_lag": 0.0,
+            "max_lag": 0.0,
+            "last_sample_lag": 0.0,
+            "max_sample_lag": 0.0,
+        }
+        self.writer_thread = threading.Thread(target=self._writer_worker)
+        self.writer_thread.start()
+
+        worker_args = [chunked, max_chunk_size, chunk_timeout]
+        self.worker_thread = threading.Thread(
+            target=self._start_recording_worker, args=worker_args
+        )
+        self.worker_thread.start()
 
-        worker_args = [filename]
-        t = threading.Thread(target=self._start_recording_worker, args=worker_args)
-        t.start()
+    def _open_inlets(self, clocksync):
+        """Reopen both inlets if their clock synchronization does not match clocksync."""
+        if clocksync == self.clocksync:
+            return
+        self.eeg_inlet.close_stream()
+        self.marker_inlet.close_stream()
+        self.eeg_inlet = open_inlet(self.eeg_info, clocksync)
+        self.marker_inlet = open_inlet(self.marker_info, clocksync)
+        self.clocksync = clocksync
+
+    def _capture_clock_offsets(self) -> bool:
+        """Record the current time_correction() offsets of both inlets.
 
-    def _start_recording_worker(self, filename):
+        Returns:
+            bool: False if an offset is not measured yet, and nothing was recorded.
+        """
+        try:
+            eeg_offset = self.eeg_inlet.time_correction(timeout=TIME_CORRECTION_TIMEOUT)
+            marker_offset = self.marker_inlet.time_correction(
+                timeout=TIME_CORRECTION_TIMEOUT
+            )
+        except pylsl.TimeoutError:
+            return False
+        row = (pylsl.local_clock(), eeg_offset, marker_offset)
+        self.clock_offsets.append(row)
+        if self.journal is not None:
+            self.journal.write_clock_offset(*row)
+        return True
+
+    def _start_recording_worker(self, chunked, max_chunk_size, chunk_timeout):
         """Worker function to record the data to a CSV file.
         This function should not be called directly. Use start() instead.
         """
 
-        eeg_timestamp_list = np.array([])
-        channel_lists: typing.List[np.ndarray] = list()
-        for i in range(8):
-            channel_lists.append(np.array([]))
+        eeg_buffer = SampleBuffer(EEG_BUFFER_SIZE, len(self.channel_names))
+        marker_buffer = SampleBuffer(MARKER_BUFFER_SIZE, MARKER_CHANNELS)
 
-        marker_timestamp_list = np.array([])
-        has_new_image_list = np.array([])
-        new_image_list = np.array([])
-        has_new_status_list = np.array([])
-        new_status_list = np.array([])
-
-        eeg_buffer_size = 0
+        if chunked:
+            eeg_chunk = np.empty(
+                (max_chunk_size, self.eeg_inlet.channel_count),
+                dtype=LSL_DTYPES[self.eeg_inlet.channel_format],
+            )
 
         # Flush the inlets to remove old data
         self.eeg_inlet.flush()
         self.marker_inlet.flush()
 
-        self._save_buffer(
-            filename,
-            eeg_timestamp_list,
-            marker_timestamp_list,
-            channel_lists,
-            has_new_image_list,
-            new_image_list,
-            has_new_status_list,
-            new_status_list,
-        )
+        next_capture = time.monotonic()
 
-        while self.recording:
-            # PROBLEM - we need to merge the two (EEG and Marker) LSL streams into one
-            # Assume we never get two markers for one EEG sample
-            # Therefore when we pull a marker, we can attach it to the next pulled EEG sample
-            # This effectively discards the marker timestamps but the EEG is recorded so quickly that it doesn't matter (?)
+        self._queue_blocks(eeg_buffer.take(), marker_buffer.take())
 
-            if self.paused:
+        while self.recording:
+            # Only the worker clears paused_at, so a pause that ended before it was noticed is still recorded
+            if self.paused or self.paused_at is not None:
+                self._wait_while_paused(eeg_buffer, marker_buffer)
                 continue
 
-            eeg_sample, eeg_timestamp = self.eeg_inlet.pull_sample()
-            marker_sample, marker_timestamp = self.marker_inlet.pull_sample(0.0)
-
-            if marker_sample is not None:
-                # print("recieved", self.t+marker_timestamp)
-                print(
-                    f"eeg_timestamp: {eeg_timestamp}, marker_timestamp: {marker_timestamp}, delta={eeg_timestamp-marker_timestamp}"
+            if time.monotonic() >= next_capture and self._capture_clock_offsets():
+                next_capture = time.monotonic() + CLOCK_OFFSET_INTERVAL
+
+            if chunked:
+                self._pull_chunk(eeg_buffer, marker_buffer, eeg_chunk, chunk_timeout)
+            else:
+                self._pull_sample(eeg_buffer, marker_buffer)
+
+            if self.journal is not None and self.journal.sync_due():
+                self._write_journal(eeg_buffer, marker_buffer)
+                self.journal.sync()
+
+        # Markers sent right before stop(), e.g. the stop marker, may not have been pulled yet
+        self._pull_markers(eeg_buffer, marker_buffer)
+
+        if not self._capture_clock_offsets() and not self.clock_offsets:
+            logger.warning("No time_correction() offsets were measured during the recording")
+        self._write_journal(eeg_buffer, marker_buffer)
+        self._queue_blocks(eeg_buffer.take(), marker_buffer.take())
+        self.writer_queue.put(None)
+        self.writer_thread.join()
+        self.storage.write_pauses(self.pauses)
+        self.storage.write_clock_offsets(self.clock_offsets)
+        self.storage.close()
+        if self.journal is not None:
+            # The journal is the only complete copy of blocks that did not reach the session file
+            incomplete = self.writer_stats["dropped_blocks"] or self.writer_stats["write_errors"]
+            if incomplete:
+                self.journal.sync()
+                logger.error(
+                    f"The session file is incomplete, keeping the journal {self.journal.path}. "
+                    f"Rebuild the session from it with python -m backend.journal {self.journal.path}"
                 )
+            self.journal.close(delete=not incomplete)
+
+        self.metrics.flush()
+        self.metrics.write(self.metrics_path)
+        logger.info(f"Recording metrics: {self.metrics.summary()}")
+        self._report_writer_stats()
+
+    def _report_writer_stats(self):
+        """Log what the writer wrote, and as an error, the blocks it dropped or failed to write."""
+        stats = self.writer_stats
+        logger.info(
+            f"Writer: {stats['blocks_written']} blocks, {stats['samples_written']} samples written, "
+            f"{stats['stalls']} stalls ({stats['stall_time']:.3f}s)"
+        )
+        if stats["dropped_blocks"] or stats["write_errors"]:
+            logger.error(
+                f"The session file is missing {stats['dropped_samples']} samples: "
+                f"{stats['dropped_blocks']} blocks were dropped from the writer queue and "
+                f"{stats['write_errors']} blocks failed to write"
+            )
+
+    def _write_journal(self, eeg_buffer, marker_buffer):
+        """Append the rows the buffers gained since the last journal write to the journal."""
+        if self.journal is not None:
+            self.journal.write_markers(marker_buffer.unjournaled())
+            self.journal.write_eeg(eeg_buffer.unjournaled())
+
+    def _pause_cutoff(self):
+        """Return the EEG timestamp pause() was called at, on the inlet's clock, or None if not paused."""
+        paused_at = self.paused_at
+        if paused_at is None:
+            return None
+        if not self.clocksync and self.clock_offsets:
+            # Raw stream timestamps are behind the local clock by the EEG offset
+            return paused_at - self.clock_offsets[-1][1]
+        return paused_at
+
+    def _samples_before_pause(self, timestamps) -> int:
+        """Return how many of the ordered timestamps were sampled before pause() was called."""
+        cutoff = self._pause_cutoff()
+        if cutoff is None:
+            return len(timestamps)
+        return int(np.searchsorted(timestamps, cutoff))
+
+    def _wait_while_paused(self, eeg_buffer, marker_buffer):
+        """Block the worker until unpause() or stop() is called and record the paused interval.
+
+        On resume, the samples still in the EEG inlet that were sampled before
+        pause() was called are stored, and the rest is flushed. The worker does
+        this itself, so the flush cannot race a pull. The marker inlet is not
+        flushed: markers sent while paused keep their timestamps and label the
+        first samples after the pause.
+        """
+        paused_at = self.paused_at
+        self.resume_event.wait()
+        resumed_at = pylsl.local_clock()
+
+        while True:
+            eeg_samples, eeg_timestamps = self.eeg_inlet.pull_chunk(
+                timeout=0.0, max_samples=DEFAULT_MAX_CHUNK_SIZE
+            )
+            n = self._samples_before_pause(eeg_timestamps)
+            if n:
+                self.metrics.observe_samples(eeg_timestamps[:n])
+                self._store_chunk(eeg_buffer, marker_buffer, eeg_timestamps, eeg_samples, n)
+            if n < len(eeg_timestamps) or not eeg_timestamps:
+                break
+        self.eeg_inlet.flush()
+        self.paused_at = None
+        self.metrics.restart_timeline()
+        self.pauses.append((paused_at, resumed_at))
+        if self.journal is not None:
+            self.journal.write_pause(paused_at, resumed_at)
+        logger.info(f"Recording paused for {resumed_at - paused_at:.3f}s")
+
+    def _pull_sample(self, eeg_buffer, marker_buffer):
+        """Pull one EEG sample and at most one marker into the buffers."""
+        # Markers keep their own timestamps and are placed between EEG samples by timestamp when merged
+        eeg_sample, eeg_timestamp = self.eeg_inlet.pull_sample(timeout=PULL_TIMEOUT)
+        if eeg_sample is None or not self._samples_before_pause([eeg_timestamp]):
+            return
 
-            if marker_sample is not None and marker_sample[0] is not None:
-                has_new_image, new_image, has_new_status, new_status = marker_sample
+        self.metrics.observe_sample(eeg_timestamp)
 
-                marker_timestamp_list = np.append(
-                    marker_timestamp_list, marker_timestamp
-                )
-                has_new_image_list = np.append(has_new_image_list, has_new_image)
-                new_image_list = np.append(new_image_list, new_image)
-                has_new_status_list = np.append(has_new_status_list, has_new_status)
-                new_status_list = np.append(new_status_list, new_status)
-
-            # If there is a marker sample available after we already pulled one, then the assuption that there is only one marker sample per EEG sample has been broken.
-            if self.marker_inlet.samples_available():
-                print("warning: multiple marker samples found for 1 eeg sample")
-
-            eeg_timestamp_list = np.append(eeg_timestamp_list, eeg_timestamp)
-            for i in range(8):
-                channel_lists[i] = np.append(channel_lists[i], eeg_sample[i])
-
-            eeg_buffer_size += 1
-            if eeg_buffer_size >= 16384:
-                threading.Thread(
-                    target=self._save_buffer,
-                    args=[
-                        filename,
-                        eeg_timestamp_list,
-                        marker_timestamp_list,
-                        channel_lists,
-                        has_new_image_list,
-                        new_image_list,
-                        has_new_status_list,
-                        new_status_list,
-                    ],
-                ).start()
-
-                eeg_buffer_size = 0
-
-                eeg_timestamp_list = np.array([])
-                channel_lists: typing.List[np.ndarray] = list()
-                for i in range(8):
-                    channel_lists.append(np.array([]))
-
-                marker_timestamp_list = np.array([])
-                has_new_image_list = np.array([])
-                new_image_list = np.array([])
-                has_new_status_list = np.array([])
-                new_status_list = np.array([])
-
-                print(eeg_timestamp_list)
-        self._save_buffer(
-            filename,
-            eeg_timestamp_list,
-            marker_timestamp_list,
-            channel_lists,
-            has_new_image_list,
-            new_image_list,
-            has_new_status_list,
-            new_status_list,
-        )
+        marker_sample, marker_timestamp = self.marker_inlet.pull_sample(0.0)
 
-        filepath_eeg = Path(f"collected_data/eeg_{filename}")
-        filepath_marker = Path(f"collected_data/markers_{filename}")
-        filepath_merged = Path(f"collected_data/{filename}")
+        if marker_sample is not None and marker_sample[0] is not None:
+            self.metrics.observe_marker(marker_timestamp, eeg_timestamp)
+            marker_buffer.append(marker_timestamp, marker_sample)
 
-        eeg_df = pd.read_csv(filepath_eeg)
-        marker_df = pd.read_csv(filepath_marker)
+        eeg_buffer.append(eeg_timestamp, eeg_sample)
 
-        merged = self.merge_eeg_and_marker_dfs(eeg_df, marker_df)
-        merged.to_csv(filepath_merged, index=False)
+        self._flush_if_full(eeg_buffer, marker_buffer)
 
-    def _save_buffer(
-        self,
-        filename,
-        eeg_timestamp_list,
-        marker_timestamp_list,
-        channel_lists,
-        has_new_image_list,
-        new_image_list,
-        has_new_status_list,
-        new_status_list,
-    ):
-        eeg_df = pd.DataFrame(
-            columns=[
-                "timestamp",
-                "ch1",
-                "ch2",
-                "ch3",
-                "ch4",
-                "ch5",
-                "ch6",
-                "ch7",
-                "ch8",
-            ]
+    def _pull_chunk(self, eeg_buffer, marker_buffer, eeg_chunk, chunk_timeout):
+        """Pull a chunk of EEG samples into eeg_chunk and drain all pending markers.
+
+        Markers keep their own LSL timestamps and are placed on the EEG timeline
+        by timestamp when the session is merged, so they do not need to be
+        paired with a particular EEG sample here.
+        """
+        _, eeg_timestamps = self.eeg_inlet.pull_chunk(
+            timeout=chunk_timeout, max_samples=len(eeg_chunk), dest_obj=eeg_chunk
         )
 
-        marker_df = pd.DataFrame(
-            columns=[
-                "timestamp",
-                "has_new_image",
-                "new_image",
-                "has_new_status",
-                "new_status",
-            ]
+        # Samples of a pull that was still waiting when pause() was called belong to the pause
+        n = self._samples_before_pause(eeg_timestamps)
+        if n:
+            self.metrics.observe_samples(eeg_timestamps[:n])
+
+        self._pull_markers(eeg_buffer, marker_buffer)
+        self._store_chunk(eeg_buffer, marker_buffer, eeg_timestamps, eeg_chunk, n)
+
+    def _store_chunk(self, eeg_buffer, marker_buffer, eeg_timestamps, eeg_samples, n):
+        """Write the first n samples of a pulled chunk to the EEG buffer, handing off full blocks."""
+        eeg_samples = np.asarray(eeg_samples)
+        written = 0
+        while written < n:
+            written += eeg_buffer.extend(eeg_timestamps[written:n], eeg_samples[written:n])
+            self._flush_if_full(eeg_buffer, marker_buffer)
+
+    def _pull_markers(self, eeg_buffer, marker_buffer):
+        """Drain all pending markers into the marker buffer."""
+        marker_samples, marker_timestamps = self.marker_inlet.pull_chunk(0.0)
+        for marker_sample, marker_timestamp in zip(marker_samples, marker_timestamps):
+            self.metrics.observe_marker(marker_timestamp, self.metrics.last_timestamp)
+            if marker_buffer.full():
+                self._flush_if_full(eeg_buffer, marker_buffer)
+            marker_buffer.append(marker_timestamp, marker_sample)
+
+    def _flush_if_full(self, eeg_buffer, marker_buffer):
+        """Hand the buffered blocks to the writer thread once either buffer is full."""
+        if eeg_buffer.full() or marker_buffer.full():
+            self._write_journal(eeg_buffer, marker_buffer)
+            self._queue_blocks(eeg_buffer.take(), marker_buffer.take())
+
+    def _queue_blocks(self, eeg_block: np.ndarray, marker_block: np.ndarray):
+        """Queue a pair of blocks for the writer thread.
+
+        If the queue is full the worker blocks (back-pressure) and the stall is
+        counted. The LSL inlets keep buffering in the meantime. If the writer
+        makes no progress for WRITER_PUT_TIMEOUT seconds, the blocks are dropped
+        and counted instead of stalling acquisition indefinitely.
+        """
+        item = (eeg_block, marker_block, time.perf_counter())
+        try:
+            self.writer_queue.put_nowait(item)
+        except queue.Full:
+            self.writer_stats["stalls"] += 1
+            stall_start = time.perf_counter()
+            try:
+                self.writer_queue.put(item, timeout=WRITER_PUT_TIMEOUT)
+            except queue.Full:
+                self.writer_stats["dropped_blocks"] += 1
+                self.writer_stats["dropped_samples"] += len(eeg_block)
+                logger.error(
+                    f"Writer queue full for {WRITER_PUT_TIMEOUT}s, dropped {len(eeg_block)} samples"
+                )
+            self.writer_stats["stall_time"] += time.perf_counter() - stall_start
+
+        self.writer_stats["queue_high_water"] = max(
+            self.writer_stats["queue_high_water"], self.writer_queue.qsize()
         )
 
-        eeg_df["timestamp"] = eeg_timestamp_list
-        for i in range(8):
-            eeg_df[f"ch{i+1}"] = channel_lists[i]
+    def _writer_worker(self):
+        """Write queued blocks to the session storage, in order, until a None item is queued.
+        This function should not be called directly. Use start() instead.
+        """
+        while True:
+            item = self.writer_queue.get()
+            if item is None:
+                break
+
+            eeg_block, marker_block, queued_at = item
+            try:
+                self._save_buffer(eeg_block, marker_block)
+            except Exception:
+                logger.exception(f"Failed to write a block of {len(eeg_block)} samples")
+                self.writer_stats["write_errors"] += 1
+                self.writer_stats["dropped_samples"] += len(eeg_block)
+                continue
 
-        marker_df["timestamp"] = marker_timestamp_list
-        marker_df["has_new_image"] = has_new_image_list.astype("int")
-        marker_df["new_image"] = new_image_list.astype("int")
-        marker_df["has_new_status"] = has_new_status_list.astype("int")
-        marker_df["new_status"] = new_status_list.astype("int")
+            lag = time.perf_counter() - queued_at
+            self.writer_stats["blocks_written"] += 1
+            self.writer_stats["samples_written"] += len(eeg_block)
+            self.writer_stats["last_lag"] = lag
+            self.writer_stats["max_lag"] = max(self.writer_stats["max_lag"], lag)
+            if len(eeg_block):
+                sample_lag = pylsl.local_clock() - eeg_block[-1, 0]
+                self.writer_stats["last_sample_lag"] = sample_lag
+                self.writer_stats["max_sample_lag"] = max(
+                    self.writer_stats["max_sample_lag"], sample_lag
+                )
 
-        filepath_eeg = Path(f"collected_data/eeg_{filename}")
-        filepath_marker = Path(f"collected_data/markers_{filename}")
+    def _save_buffer(self, eeg_block: np.ndarray, marker_block: np.ndarray):
+        """Append a block of EEG samples and a block of markers to the session storage.
+
+        Args:
+            eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+            marker_block (np.ndarray): (markers x 5) array, timestamp first.
+        """
+        self.storage.append(eeg_block, marker_block)
+
+    def get_writer_stats(self) -> dict:
+        """Return the writer metrics of the current or last recording.
+
+        Returns:
+            dict: Blocks and samples written, current queue depth and high-water mark,
+                back-pressure stalls and time spent stalled, blocks dropped from the queue,
+                blocks that failed to write, samples lost either way,
+                the last and max queue-to-disk lag in seconds, and the last and max
+                sample-to-disk lag, i.e. the age of the newest sample of a block when
+                it was written, in seconds.
+        """
+        stats = dict(self.writer_stats)
+        stats["queue_depth"] = self.writer_queue.qsize() if self.writer_queue else 0
+        return stats
 
-        filepath_eeg.parent.mkdir(parents=True, exist_ok=True)
+    def get_metrics(self, include_bins=False) -> dict:
+        """Return the timing metrics of the current or last recording.
 
-        eeg_df.to_csv(
-            filepath_eeg,
-            mode="a",
-            index=False,
-            header=(not os.path.exists(filepath_eeg)),
-        )
+        Args:
+            include_bins (bool, optional): Include the histogram bins. Defaults to False.
 
-        marker_df.to_csv(
-            filepath_marker,
-            mode="a",
-            index=False,
-            header=(not os.path.exists(filepath_marker)),
-        )
+        Returns:
+            dict: See backend.metrics.RecorderMetrics.summary. Empty before the first recording.
+        """
+        return self.metrics.summary(include_bins) if self.metrics else {}
 
-    # TODO: write buffered version of function
     def merge_eeg_and_marker_dfs(self, eeg_df: pd.DataFrame, marker_df: pd.DataFrame):
-        merged = pd.DataFrame(
-            columns=[
-                "timestamp",
-                "ch1",
-                "ch2",
-                "ch3",
-                "ch4",
-                "ch5",
-                "ch6",
-                "ch7",
-                "ch8",
-                "status",
-                "image_id",
-            ]
-        )
+        """Label every EEG sample with the status and image active at its timestamp.
+
+        A marker applies from the first EEG sample whose timestamp is strictly
+        greater than the marker timestamp until the next marker of the same kind.
+        Samples before the first status marker are STATUS_TRANSITION and samples
+        before the first image marker are IMAGE_NONE.
 
-        merged["timestamp"] = eeg_df["timestamp"]
-        for i in range(8):
-            merged[f"ch{i+1}"] = eeg_df[f"ch{i+1}"]
+        Args:
+            eeg_df (pd.DataFrame): EEG samples as written to eeg_*.csv.
+            marker_df (pd.DataFrame): Markers as written to markers_*.csv.
+
+        Returns:
+            pd.DataFrame: EEG samples with status, image_id and one-hot label columns.
+        """
+        if not eeg_df["timestamp"].is_monotonic_increasing:
+            eeg_df = eeg_df.sort_values("timestamp", kind="stable", ignore_index=True)
+
+        merged = eeg_df[["timestamp"] + get_csv_channel_names(eeg_df)].reset_index()
+        eeg_timestamps = merged["timestamp"].to_numpy()
 
-        merged["status"] = np.repeat(-100, len(merged["timestamp"]))
-        merged["image_id"] = np.repeat(-100, len(merged["timestamp"]))
-        merged = merged.reset_index()
         marker_new_image_rows = marker_df[marker_df["has_new_image"] == 1]
         marker_new_status_rows = marker_df[marker_df["has_new_status"] == 1]
 
-        current_image = IMAGE_NONE
-        prev_eeg_index = 0
-        for row in marker_new_image_rows.itertuples():
-            timestamp = row.timestamp
-            eeg_index = merged[merged["timestamp"] > timestamp].iloc[0]["index"]
-            merged.loc[prev_eeg_index : eeg_index - 1, "image_id"] = current_image
-            prev_eeg_index = eeg_index
-            current_image = row.new_image
-        merged.loc[eeg_index:, "image_id"] = current_image
-
-        current_status = STATUS_TRANSITION
-        prev_eeg_index = 0
-        for row in marker_new_status_rows.itertuples():
-            timestamp = row.timestamp
-            eeg_index = merged[merged["timestamp"] > timestamp].iloc[0]["index"]
-            merged.loc[prev_eeg_index : eeg_index - 1, "status"] = current_status
-            prev_eeg_index = eeg_index
-            current_status = row.new_status
-        merged.loc[eeg_index:, "image_id"] = current_status
-
-        merged["transition"] = (merged["status"] == STATUS_TRANSITION).astype(int)
-        merged["baseline"] = (merged["status"] == STATUS_BASELINE).astype(int)
-        merged["imagine"] = (merged["status"] == STATUS_IMAGINE).astype(int)
-        merged["look"] = (merged["status"] == STATUS_LOOK).astype(int)
-        merged["imagine_eyes_closed"] = (
-            merged["status"] == STATUS_IMAGINE_EYES_CLOSED
-        ).astype(int)
-        merged["done"] = (merged["status"] == STATUS_DONE).astype(int)
+        merged["status"] = forward_fill_markers(
+            eeg_timestamps,
+            marker_new_status_rows["timestamp"].to_numpy(),
+            marker_new_status_rows["new_status"].to_numpy(),
+            STATUS_TRANSITION,
+        )
+        merged["image_id"] = forward_fill_markers(
+            eeg_timestamps,
+            marker_new_image_rows["timestamp"].to_numpy(),
+            marker_new_image_rows["new_image"].to_numpy(),
+            IMAGE_NONE,
+        )
 
-        for i in range(self.num_imgs):
-            merged[f"image_{i}"] = (merged["image_id"] == i).astype(int)
-        merged["image_none"] = (merged["image_id"] == IMAGE_NONE).astype(int)
+        add_label_columns(merged, self.num_imgs)
 
         return merged
 
     def pause(self):
+        """Stop recording samples until unpause() is called.
+
+        EEG sampled from now until the worker resumes is discarded. Samples taken
+        before this call are still recorded, even if they have not been pulled yet.
+        """
+        self.paused_at = pylsl.local_clock()
+        self.resume_event.clear()
         self.paused = True
 
     def unpause(self):
-        # Flush the inlets to remove old data
-        self.eeg_inlet.flush()
-        self.marker_inlet.flush()
+        """Resume recording. The worker stores the samples from before the pause and flushes the rest."""
         self.paused = False
+        self.resume_event.set()
+
+    def get_paused_duration(self) -> float:
+        """Return the total time in seconds the current or last recording spent paused."""
+        return sum(resumed_at - paused_at for paused_at, resumed_at in self.pauses)
 
     def stop(self):
-        """Finish recording data to a CSV file."""
+        """Finish recording data to a CSV file.
+        Returns once the last block has been written, so the merged file is complete.
+        """
         self.recording = False
+        self.resume_event.set()
+        if self.worker_thread is not None:
+            self.worker_thread.join()
+            self.worker_thread = None
 
 
 def test_recorder():
@@ -409,3 +883,100 @@ def test_recorder():
         os.fsync(self.file.fileno())  # Ensure data is written to disk
         self.file.close()
         print("Data saved. Session closed.")
+
+
+def test_merge_eeg_and_marker_dfs(num_sessions=20, seed=0):
+    """Check the vectorized and streaming merges against the original per-marker loop on synthetic sessions."""
+
+    def loop_merge(eeg_df, marker_df, num_imgs):
+        merged = eeg_df[["timestamp"] + get_csv_channel_names(eeg_df)]
+        merged = merged.assign(status=-100, image_id=-100).reset_index()
+
+        for column, flag, value, initial in [
+            ("image_id", "has_new_image", "new_image", IMAGE_NONE),
+            ("status", "has_new_status", "new_status", STATUS_TRANSITION),
+        ]:
+            current = initial
+            prev_eeg_index = 0
+            for row in marker_df[marker_df[flag] == 1].itertuples():
+                eeg_index = merged[merged["timestamp"] > row.timestamp].iloc[0]["index"]
+                merged.loc[prev_eeg_index : eeg_index - 1, column] = current
+                prev_eeg_index = eeg_index
+                current = getattr(row, value)
+            merged.loc[prev_eeg_index:, column] = current
+
+        merged["transition"] = (merged["status"] == STATUS_TRANSITION).astype(int)
+        merged["baseline"] = (merged["status"] == STATUS_BASELINE).astype(int)
+        merged["imagine"] = (merged["status"] == STATUS_IMAGINE).astype(int)
+        merged["look"] = (merged["status"] == STATUS_LOOK).astype(int)
+        merged["imagine_eyes_closed"] = (
+            merged["status"] == STATUS_IMAGINE_EYES_CLOSED
+        ).astype(int)
+        merged["done"] = (merged["status"] == STATUS_DONE).astype(int)
+        for i in range(num_imgs):
+            merged[f"image_{i}"] = (merged["image_id"] == i).astype(int)
+        merged["image_none"] = (merged["image_id"] == IMAGE_NONE).astype(int)
+        return merged
+
+    rng = np.random.default_rng(seed)
+    collector = CSVDataRecorder(find_streams=False)
+    statuses = [STATUS_BASELINE, STATUS_IMAGINE, STATUS_LOOK, STATUS_TRANSITION]
+
+    for _ in range(num_sessions):
+        num_samples = int(rng.integers(500, 5000))
+        channel_names = [f"ch{i+1}" for i in range(rng.choice([8, 16, 32]))]
+        eeg_timestamps = 100 + np.cumsum(rng.uniform(0.003, 0.005, num_samples))
+        eeg_df = pd.DataFrame(
+            rng.normal(size=(num_samples, len(channel_names))),
+            columns=channel_names,
+        )
+        eeg_df.insert(0, "timestamp", eeg_timestamps)
+
+        num_markers = int(rng.integers(1, 40))
+        marker_df = pd.DataFrame(
+            {
+                "timestamp": np.sort(
+                    rng.uniform(eeg_timestamps[0] - 0.1, eeg_timestamps[-2], num_markers)
+                ),
+                "has_new_image": rng.integers(0, 2, num_markers),
+                "new_image": rng.integers(0, collector.num_imgs, num_markers),
+                "has_new_status": np.ones(num_markers, dtype=int),
+                "new_status": rng.choice(statuses, num_markers),
+            }
+        )
+        marker_df.loc[0, "has_new_image"] = 1
+
+        expected = loop_merge(eeg_df, marker_df, collector.num_imgs)
+        pd.testing.assert_frame_equal(
+            collector.merge_eeg_and_marker_dfs(eeg_df, marker_df), expected
+        )
+
+        # Feed the same session to the streaming merger in random blocks
+        merger = StreamingMerger(channel_names, collector.num_imgs)
+        eeg_values = eeg_df.to_numpy()
+        marker_values = marker_df.to_numpy(dtype=float)
+        bounds = np.sort(rng.integers(0, num_samples, 5))
+        blocks = []
+        marker_start = 0
+        for eeg_start, eeg_end in zip(np.r_[0, bounds], np.r_[bounds, num_samples]):
+            # Markers are flushed with the block that was being recorded when they arrived
+            marker_end = np.searchsorted(
+                marker_values[:, 0], eeg_timestamps[eeg_end - 1] if eeg_end else -np.inf
+            )
+            blocks.append(
+                merger.merge_block(
+                    eeg_values[eeg_start:eeg_end], marker_values[marker_start:marker_end]
+                )
+            )
+            marker_start = marker_end
+        streamed = pd.concat(blocks, ignore_index=True)
+        pd.testing.assert_frame_equal(streamed.drop(columns="marker_onset"), expected)
+
+        # Every marker is reported on the sample it takes effect on, at its fractional index
+        rows = np.searchsorted(eeg_timestamps, marker_values[:, 0], side="right")
+        onsets = np.interp(marker_values[:, 0], eeg_timestamps, np.arange(num_samples))
+        expected_onsets = np.full(num_samples, np.nan)
+        expected_onsets[rows] = onsets
+        np.testing.assert_allclose(streamed["marker_onset"], expected_onsets, rtol=0, atol=1e-6)
+
+    print(f"Vectorized and streaming merges match the loop merge on {num_sessions} sessions")
@@ -0,0 +1,195 @@
+import time
+import logging
+
+import pylsl
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_TIMEOUT = 10.0
+"""Seconds to wait for all requested streams before discovery fails
+"""
+
+CONNECT_TIMEOUT = 0.5
+"""Seconds an inlet may take to connect to a resolved stream before it is resolved again
+"""
+
+RESOLVE_POLL_INTERVAL = 0.02
+"""Seconds between two reads of the resolver's results while waiting for streams
+"""
+
+_resolved_streams = {}
+"""Resolved StreamInfo of every query found so far, by StreamQuery.key()
+"""
+
+
+class StreamNotFoundError(RuntimeError):
+    """Raised when a requested LSL stream is not found before the discovery deadline."""
+
+
+class StreamQuery:
+    """Selects an LSL stream by type, and optionally by name and source_id.
+
+    Example:
+        StreamQuery("EEG", name="obci_eeg1")
+    """
+
+    def __init__(self, stream_type, name=None, source_id=None):
+        self.stream_type = stream_type
+        self.name = name
+        self.source_id = source_id
+
+    def key(self) -> tuple:
+        return (self.stream_type, self.name, self.source_id)
+
+    def predicate(self) -> str:
+        """Return the XPath predicate liblsl resolves this query with."""
+        clauses = [f"type='{self.stream_type}'"]
+        if self.name is not None:
+            clauses.append(f"name='{self.name}'")
+        if self.source_id is not None:
+            clauses.append(f"source_id='{self.source_id}'")
+        return " and ".join(clauses)
+
+    def matches(self, info: pylsl.StreamInfo) -> bool:
+        return (
+            info.type() == self.stream_type
+            and (self.name is None or info.name() == self.name)
+            and (self.source_id is None or info.source_id() == self.source_id)
+        )
+
+    def __str__(self):
+        return self.predicate()
+
+
+def _select(query: StreamQuery, streams):
+    """Pick the newest of the streams matching a query, warning if the choice is ambiguous."""
+    streams = sorted(streams, key=lambda info: info.created_at(), reverse=True)
+    if len(streams) > 1:
+        logger.warning(
+            f"{len(streams)} streams match {query}: "
+            + ", ".join(f"{s.name()} ({s.source_id()})" for s in streams)
+            + f". Using the newest, {streams[0].name()}. Select a stream by name or source_id "
+            "to choose another one."
+        )
+    return streams[0]
+
+
+def resolve_streams(queries: dict, timeout=DISCOVERY_TIMEOUT) -> dict:
+    """Resolve several streams at once, returning as soon as every query has a match.
+
+    All queries share one resolver, so finding an EEG and a marker stream
+    takes one discovery round instead of one per stream.
+
+    Args:
+        queries (dict): StreamQuery to resolve, by role (e.g. "eeg", "marker").
+        timeout (float, optional): Seconds to wait for all streams. Defaults to DISCOVERY_TIMEOUT.
+
+    Raises:
+        StreamNotFoundError: If a query has no match when the timeout expires.
+
+    Returns:
+        dict: Resolved pylsl.StreamInfo of every role.
+    """
+    predicate = " or ".join(f"({query.predicate()})" for query in queries.values())
+    resolver = pylsl.ContinuousResolver(pred=predicate)
+    deadline = time.monotonic() + timeout
+    found = {}
+
+    while True:
+        streams = resolver.results()
+        for role, query in queries.items():
+            if role not in found:
+                matches = [info for info in streams if query.matches(info)]
+                if matches:
+                    found[role] = _select(query, matches)
+        if len(found) == len(queries) or time.monotonic() >= deadline:
+            break
+        time.sleep(RESOLVE_POLL_INTERVAL)
+
+    missing = [f"{role} ({query})" for role, query in queries.items() if role not in found]
+    if missing:
+        raise StreamNotFoundError(
+            f"No LSL stream found for {', '.join(missing)} within {timeout:g} s. "
+            "Check that the stream is running and visible on this network."
+        )
+
+    for role, info in found.items():
+        _resolved_streams[queries[role].key()] = info
+        logger.info(
+            f"Resolved {role} stream: {info.name()} ({info.source_id()}), "
+            f"{info.channel_count()} channels at {info.nominal_srate():g} Hz"
+        )
+    return found
+
+
+def find_streams(queries: dict, timeout=DISCOVERY_TIMEOUT, use_cache=True) -> dict:
+    """Return the StreamInfo of several streams, resolving only those not found before.
+
+    Args:
+        queries (dict): StreamQuery to find, by role.
+        timeout (float, optional): Seconds to wait for the streams that are resolved.
+            Defaults to DISCOVERY_TIMEOUT.
+        use_cache (bool, optional): Reuse the StreamInfo of earlier discoveries. Defaults to True.
+
+    Raises:
+        StreamNotFoundError: If a stream is not found when the timeout expires.
+
+    Returns:
+        dict: Resolved pylsl.StreamInfo of every role.
+    """
+    found = {}
+    if use_cache:
+        for role, query in queries.items():
+            if query.key() in _resolved_streams:
+                found[role] = _resolved_streams[query.key()]
+    missing = {role: query for role, query in queries.items() if role not in found}
+    if missing:
+        found.update(resolve_streams(missing, timeout))
+    return found
+
+
+def forget_stream(query: StreamQuery):
+    """Drop the cached StreamInfo of a query, so the next discovery resolves it again."""
+    _resolved_streams.pop(query.key(), None)
+
+
+def open_inlets(queries: dict, open_inlet, timeout=DISCOVERY_TIMEOUT) -> dict:
+    """Find several streams and open a connected inlet to each.
+
+    Cached streams are connected to directly. A cached stream that does not
+    accept the connection within CONNECT_TIMEOUT, e.g. because its outlet
+    was restarted, is resolved again.
+
+    Args:
+        queries (dict): StreamQuery to open, by role.
+        open_inlet (callable): Opens a pylsl.StreamInlet from a resolved StreamInfo.
+        timeout (float, optional): Seconds to wait for the streams that are resolved.
+            Defaults to DISCOVERY_TIMEOUT.
+
+    Raises:
+        StreamNotFoundError: If a stream is not found or does not accept the connection.
+
+    Returns:
+        dict: (StreamInfo, StreamInlet) of every role.
+    """
+    infos = find_streams(queries, timeout)
+    opened = {}
+    for role, info in infos.items():
+        inlet = open_inlet(info)
+        try:
+            inlet.open_stream(timeout=CONNECT_TIMEOUT)
+        except (pylsl.TimeoutError, pylsl.LostError):
+            inlet.close_stream()
+            logger.info(f"Cached {role} stream {info.name()} did not connect, resolving it again")
+            forget_stream(queries[role])
+            info = resolve_streams({role: queries[role]}, timeout)[role]
+            inlet = open_inlet(info)
+            try:
+                inlet.open_stream(timeout=CONNECT_TIMEOUT)
+            except (pylsl.TimeoutError, pylsl.LostError):
+                raise StreamNotFoundError(
+                    f"The {role} stream {info.name()} ({info.source_id()}) was found but did "
+                    f"not accept a connection within {CONNECT_TIMEOUT:g} s."
+                )
+        opened[role] = (info, inlet)
+    return opened
@@ -0,0 +1,317 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from constants import *
+from backend.storage import DATA_DIR
+from backend.session_reader import SessionReader
+from backend import compression
+
+logger = logging.getLogger(__name__)
+
+EPOCH_CACHE_DIR = DATA_DIR / "epochs"
+"""Directory epoched sessions are cached in, one subdirectory per session and parameters
+"""
+
+EPOCH_STATUSES = (
+    STATUS_BASELINE,
+    STATUS_IMAGINE,
+    STATUS_LOOK,
+    STATUS_IMAGINE_EYES_CLOSED,
+)
+"""Statuses epoched by default. Transition and done runs are skipped
+"""
+
+
+def find_runs(status: np.ndarray, image_id: np.ndarray):
+    """Find the runs of consecutive samples with the same status and image.
+
+    Args:
+        status (np.ndarray): Status of every sample.
+        image_id (np.ndarray): Image id of every sample.
+
+    Returns:
+        tuple: starts and stops (exclusive) of every run, as sample indices.
+    """
+    n = len(status)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    status = np.asarray(status)
+    image_id = np.asarray(image_id)
+    changes = np.flatnonzero(
+        (status[1:] != status[:-1]) | (image_id[1:] != image_id[:-1])
+    ) + 1
+    starts = np.concatenate([[0], changes])
+    stops = np.concatenate([changes, [n]])
+    return starts, stops
+
+
+def epoch_arrays(
+    timestamps: np.ndarray,
+    channels: np.ndarray,
+    status: np.ndarray,
+    image_id: np.ndarray,
+    pre: int,
+    post: int,
+    statuses=EPOCH_STATUSES,
+):
+    """Cut one fixed-length epoch around the onset of every (status, image_id) run.
+
+    Each epoch covers samples [onset - pre, onset + post). All epochs are
+    gathered with one fancy index, so a memory-mapped session only reads the
+    samples that end up in an epoch. Runs whose epoch would start before the
+    first or end after the last sample are dropped.
+
+    Args:
+        timestamps (np.ndarray): Timestamp of every sample.
+        channels (np.ndarray): (samples x channels) array.
+        status (np.ndarray): Status of every sample.
+        image_id (np.ndarray): Image id of every sample.
+        pre (int): Samples before the onset included in each epoch.
+        post (int): Samples from the onset on included in each epoch.
+        statuses (iterable, optional): Statuses to epoch. Defaults to EPOCH_STATUSES.
+
+    Returns:
+        tuple: (epochs x channels x samples) float32 array, and a label table with one
+            row per epoch (onset, onset_timestamp, run_length, status, image_id).
+    """
+    status = np.asarray(status)
+    image_id = np.asarray(image_id)
+    starts, stops = find_runs(status, image_id)
+
+    keep = np.isin(status[starts], list(statuses))
+    keep &= (starts - pre >= 0) & (starts + post <= len(status))
+    starts, stops = starts[keep], stops[keep]
+
+    indices = starts[:, None] + np.arange(-pre, post)[None, :]
+    epochs = np.asarray(channels)[indices].astype(np.float32).transpose(0, 2, 1)
+
+    labels = pd.DataFrame(
+        {
+            "onset": starts,
+            "onset_timestamp": np.asarray(timestamps)[starts],
+            "run_length": stops - starts,
+            "status": status[starts].astype(np.int64),
+            "image_id": image_id[starts].astype(np.int64),
+        }
+    )
+    return np.ascontiguousarray(epochs), labels
+
+
+def find_session(session):
+    """Return the kind ("npy", "eegz" or "csv") and path of a recorded session."""
+    path = Path(session)
+    stem = path.stem
+    for candidate in [path, DATA_DIR / stem]:
+        if (candidate / "session.json").exists():
+            return "npy", candidate
+    for candidate in [path, DATA_DIR / f"{stem}.eegz"]:
+        if candidate.suffix == ".eegz" and candidate.exists():
+            return "eegz", candidate
+    for candidate in [path, DATA_DIR / path.name]:
+        if candidate.suffix == ".csv" and candidate.exists():
+            return "csv", candidate
+    raise FileNotFoundError(f"No recorded session found for {session}")
+
+
+def load_session_columns(session) -> dict:
+    """Load the timestamps, channels, status and image_id of a recorded session.
+
+    Npy sessions are memory-mapped, .eegz sessions are decoded block by
+    block and merged CSV files are read without their one-hot label columns.
+
+    Args:
+        session (str or Path): Name the session was recorded under (e.g. "03-14_10-00-00.csv"),
+            or the path to its npy directory, .eegz file or merged CSV file.
+
+    Returns:
+        dict: timestamps, channels (samples x channels), status, image_id and channel_names.
+    """
+    kind, path = find_session(session)
+
+    if kind == "npy":
+        reader = SessionReader(path)
+        columns = reader.slice(0, len(reader))
+        columns["channel_names"] = reader.channel_names
+        return columns
+
+    if kind == "eegz":
+        channel_names = compression.read_metadata(path)["channels"]
+        blocks = list(compression.iter_blocks(path))
+        # Empty columns in the dtypes the blocks decode to, so an empty session concatenates to them
+        empty = {
+            "timestamps": np.empty(0, dtype=np.float64),
+            "channels": np.empty((0, len(channel_names)), dtype=np.float32),
+            "status": np.empty(0, dtype=np.int32),
+            "image_id": np.empty(0, dtype=np.int32),
+        }
+        columns = {
+            key: np.concatenate([empty[key]] + [block[key] for block in blocks])
+            for key in empty
+        }
+        columns["channel_names"] = channel_names
+        return columns
+
+    header = pd.read_csv(path, nrows=0).columns
+    end = header.get_loc("status")
+    channel_names = [c for c in header[:end] if c not in ("index", "timestamp")]
+    merged = pd.read_csv(
+        path,
+        usecols=["timestamp"] + channel_names + ["status", "image_id"],
+        float_precision="round_trip",
+    )
+    return {
+        "timestamps": merged["timestamp"].to_numpy(),
+        "channels": merged[channel_names].to_numpy(dtype=np.float32),
+        "status": merged["status"].to_numpy(),
+        "image_id": merged["image_id"].to_numpy(),
+        "channel_names": channel_names,
+    }
+
+
+def _cache_key(kind, path, params) -> str:
+    """Key of a session's epochs, changing whenever the session data or the parameters change."""
+    data_file = path / "channels.npy" if kind == "npy" else path
+    stat = os.stat(data_file)
+    key = json.dumps(
+        {
+            "source": str(Path(path).resolve()),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            **params,
+        },
+        sort_keys=True,
+    )
+    return f"{Path(path).stem}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}"
+
+
+def epoch_session(
+    session,
+    pre,
+    post,
+    statuses=EPOCH_STATUSES,
+    cache_dir=EPOCH_CACHE_DIR,
+    use_cache=True,
+):
+    """Epoch a recorded session, reusing the cached result of an earlier call with the same parameters.
+
+    The epochs are cached in cache_dir/<session>_<hash>/ as epochs.npy, labels.csv
+    and params.json. The hash covers the parameters and the size and modification
+    time of the session, so re-recording or recovering a session invalidates its
+    cached epochs. Cached epochs are returned memory-mapped.
+
+    Args:
+        session (str or Path): Name the session was recorded under (e.g. "03-14_10-00-00.csv"),
+            or the path to its npy directory, .eegz file or merged CSV file.
+        pre (int): Samples before each run onset included in its epoch.
+        post (int): Samples from each run onset on included in its epoch.
+        statuses (iterable, optional): Statuses to epoch. Defaults to EPOCH_STATUSES.
+        cache_dir (str or Path, optional): Cache directory. Defaults to EPOCH_CACHE_DIR.
+        use_cache (bool, optional): Whether to read and write the cache. Defaults to True.
+
+    Returns:
+        tuple: (epochs x channels x samples) float32 array and the label table, see epoch_arrays.
+    """
+    kind, path = find_session(session)
+    params = {"pre": int(pre), "post": int(post), "statuses": sorted(int(s) for s in statuses)}
+    directory = Path(cache_dir) / _cache_key(kind, path, params)
+
+    if use_cache and (directory / "params.json").exists():
+        logger.info(f"Loading cached epochs of {session} from {directory}")
+        return (
+            np.load(directory / "epochs.npy", mmap_mode="r"),
+            pd.read_csv(directory / "labels.csv", float_precision="round_trip"),
+        )
+
+    columns = load_session_columns(session)
+    epochs, labels = epoch_arrays(
+        columns["timestamps"],
+        columns["channels"],
+        columns["status"],
+        columns["image_id"],
+        params["pre"],
+        params["post"],
+        params["statuses"],
+    )
+
+    if use_cache:
+        # Write to a temporary directory first, so an interrupted write is never read back
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_"))
+        np.save(tmp / "epochs.npy", epochs)
+        labels.to_csv(tmp / "labels.csv", index=False)
+        with open(tmp / "params.json", "w") as f:
+            json.dump(
+                {"session": str(path), "channel_names": list(columns["channel_names"]), **params},
+                f,
+                indent=2,
+            )
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp, directory)
+        logger.info(f"Cached {len(labels)} epochs of {session} in {directory}")
+
+    return epochs, labels
+
+
+def test_epoch_arrays(num_sessions=20, seed=0):
+    """Check epoch_arrays against a per-sample loop on synthetic labels."""
+    rng = np.random.default_rng(seed)
+    statuses = [STATUS_BASELINE, STATUS_IMAGINE, STATUS_LOOK, STATUS_TRANSITION]
+
+    for _ in range(num_sessions):
+        num_runs = int(rng.integers(1, 30))
+        lengths = rng.integers(1, 200, num_runs)
+        status = np.repeat(rng.choice(statuses, num_runs), lengths)
+        image_id = np.repeat(rng.integers(-1, 3, num_runs), lengths)
+        timestamps = np.arange(len(status)) / 125
+        channels = rng.normal(size=(len(status), 8))
+        pre, post = int(rng.integers(0, 20)), int(rng.integers(1, 100))
+
+        epochs, labels = epoch_arrays(
+            timestamps, channels, status, image_id, pre, post
+        )
+
+        expected = []
+        for i in range(len(status)):
+            onset = i == 0 or (status[i], image_id[i]) != (status[i - 1], image_id[i - 1])
+            if (
+                onset
+                and status[i] in EPOCH_STATUSES
+                and i - pre >= 0
+                and i + post <= len(status)
+            ):
+                expected.append(i)
+
+        assert list(labels["onset"]) == expected
+        assert epochs.shape == (len(expected), channels.shape[1], pre + post)
+        for epoch, onset in zip(epochs, expected):
+            assert np.array_equal(
+                epoch, channels[onset - pre : onset + post].T.astype(np.float32)
+            )
+        assert (labels["status"].to_numpy() == status[expected]).all()
+        assert (labels["image_id"].to_numpy() == image_id[expected]).all()
+
+    print(f"epoch_arrays matches the reference loop on {num_sessions} sessions")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Epoch recorded sessions into cached (epochs x channels x samples) arrays."
+    )
+    parser.add_argument("sessions", nargs="+", help="Session names, e.g. 03-14_10-00-00.csv.")
+    parser.add_argument("--pre", type=int, default=0, help="Samples before each run onset.")
+    parser.add_argument("--post", type=int, required=True, help="Samples from each run onset on.")
+    args = parser.parse_args()
+
+    for session in args.sessions:
+        epochs, labels = epoch_session(session, args.pre, args.post)
+        print(f"{session}: {epochs.shape[0]} epochs of {epochs.shape[1]} channels x {epochs.shape[2]} samples")
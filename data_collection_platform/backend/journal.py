@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+import logging
+
+import numpy as np
+
+from pathlib import Path
+
+from constants import *
+from backend.storage import DATA_DIR, STORAGE_BACKENDS, CONVERT_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SYNC_INTERVAL = 1.0
+"""Default seconds between fsyncs of the recording journal
+"""
+
+RECORD_HEADER = struct.Struct("<cII")
+"""Journal record header: record type, payload size in bytes, CRC32 of the payload
+"""
+
+RECORD_SESSION = b"S"
+"""Journal record holding the session metadata as JSON, always the first record
+"""
+
+RECORD_EEG = b"E"
+"""Journal record holding float64 (samples x 1 + channels) EEG rows, timestamp first
+"""
+
+RECORD_MARKERS = b"M"
+"""Journal record holding float64 (markers x 5) marker rows, timestamp first
+"""
+
+RECORD_PAUSE = b"P"
+"""Journal record holding the float64 paused_at and resumed_at of one pause
+"""
+
+RECORD_CLOCK_OFFSET = b"C"
+"""Journal record holding the float64 local_time, eeg_offset and marker_offset of one time_correction() capture
+"""
+
+
+class Journal:
+    """Append-only write-ahead journal of everything the recorder has pulled.
+
+    The recorder writes the rows its sample buffers gained since the last
+    write, so the journal is written in blocks and never per sample. The
+    file is fsynced at most once every sync_interval seconds. Each record
+    carries a CRC32, so recovery stops cleanly at a record torn by a crash.
+    """
+
+    def __init__(
+        self,
+        filename,
+        channel_names,
+        num_imgs,
+        storage,
+        sync_interval,
+        data_dir=DATA_DIR,
+        clocksync=True,
+    ):
+        self.path = Path(data_dir) / f"{Path(filename).stem}.journal"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.sync_interval = sync_interval
+        self.file = open(self.path, "wb")
+        self.last_sync = time.monotonic()
+
+        metadata = {
+            "filename": filename,
+            "channel_names": list(channel_names),
+            "num_imgs": num_imgs,
+            "storage": storage,
+            "clocksync": clocksync,
+        }
+        self._write(RECORD_SESSION, json.dumps(metadata).encode("utf-8"))
+        self.sync()
+
+    def _write(self, record_type, payload: bytes):
+        self.file.write(
+            RECORD_HEADER.pack(record_type, len(payload), zlib.crc32(payload))
+        )
+        self.file.write(payload)
+
+    def write_eeg(self, rows: np.ndarray):
+        if len(rows):
+            self._write(RECORD_EEG, np.ascontiguousarray(rows, np.float64).tobytes())
+
+    def write_markers(self, rows: np.ndarray):
+        if len(rows):
+            self._write(RECORD_MARKERS, np.ascontiguousarray(rows, np.float64).tobytes())
+
+    def write_pause(self, paused_at, resumed_at):
+        self._write(RECORD_PAUSE, np.array([paused_at, resumed_at], np.float64).tobytes())
+
+    def write_clock_offset(self, local_time, eeg_offset, marker_offset):
+        self._write(
+            RECORD_CLOCK_OFFSET,
+            np.array([local_time, eeg_offset, marker_offset], np.float64).tobytes(),
+        )
+
+    def sync_due(self):
+        return time.monotonic() - self.last_sync >= self.sync_interval
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self, delete=True):
+        """Close the journal. Deletes it by default, once the session storage is complete."""
+        self.file.close()
+        if delete:
+            self.path.unlink()
+
+
+def read_journal(path):
+    """Read the records of a journal, stopping at the first torn or corrupt record.
+
+    Args:
+        path (str or Path): Path to a .journal file.
+
+    Yields:
+        tuple: (record_type, payload) for every intact record.
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            record_type, size, crc = RECORD_HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                logger.warning(f"{path}: journal truncated at byte {f.tell()}")
+                return
+            yield record_type, payload
+
+
+def recover_session(path):
+    """Rebuild a session, including its merged labels, from a recording journal.
+
+    The session is written next to the journal, replacing any partial output
+    files of the session. The journal is kept, so recovery can be re-run.
+
+    Args:
+        path (str or Path): Path to a .journal file.
+
+    Returns:
+        dict: The session metadata stored in the journal, plus the number of samples,
+            markers and pauses recovered.
+    """
+    records = read_journal(path)
+    record_type, payload = next(records)
+    if record_type != RECORD_SESSION:
+        raise ValueError(f"{path} does not start with a session record")
+    metadata = json.loads(payload)
+
+    eeg_width = 1 + len(metadata["channel_names"])
+    clock_offsets = []
+    storage = STORAGE_BACKENDS[metadata["storage"]](
+        metadata["filename"],
+        metadata["channel_names"],
+        num_imgs=metadata["num_imgs"],
+        data_dir=Path(path).parent,
+        clock_offsets=None if metadata.get("clocksync", True) else clock_offsets,
+    )
+
+    eeg_rows, marker_rows, pauses = [], [], []
+    pending_samples = num_samples = num_markers = 0
+    for record_type, payload in records:
+        values = np.frombuffer(payload, dtype=np.float64)
+        if record_type == RECORD_EEG:
+            eeg_rows.append(values.reshape(-1, eeg_width))
+            pending_samples += len(eeg_rows[-1])
+        elif record_type == RECORD_MARKERS:
+            marker_rows.append(values.reshape(-1, 1 + MARKER_CHANNELS))
+        elif record_type == RECORD_PAUSE:
+            pauses.append(tuple(values))
+        elif record_type == RECORD_CLOCK_OFFSET:
+            clock_offsets.append(tuple(values))
+
+        if pending_samples >= CONVERT_BLOCK_SIZE:
+            num_samples, num_markers = _append_rows(
+                storage, eeg_rows, marker_rows, eeg_width, num_samples, num_markers
+            )
+            eeg_rows, marker_rows, pending_samples = [], [], 0
+
+    num_samples, num_markers = _append_rows(
+        storage, eeg_rows, marker_rows, eeg_width, num_samples, num_markers
+    )
+    storage.write_pauses(pauses)
+    storage.write_clock_offsets(clock_offsets)
+    storage.close()
+
+    metadata.update(
+        num_samples=num_samples, num_markers=num_markers, num_pauses=len(pauses)
+    )
+    logger.info(f"Recovered {metadata} from {path}")
+    return metadata
+
+
+def _append_rows(storage, eeg_rows, marker_rows, eeg_width, num_samples, num_markers):
+    eeg_block = np.concatenate([np.empty((0, eeg_width))] + eeg_rows)
+    marker_block = np.concatenate([np.empty((0, 1 + MARKER_CHANNELS))] + marker_rows)
+    storage.append(eeg_block, marker_block)
+    return num_samples + len(eeg_block), num_markers + len(marker_block)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild sessions that did not stop cleanly from their recording journals."
+    )
+    parser.add_argument(
+        "journals",
+        nargs="*",
+        help="Journal files. Defaults to every .journal file in collected_data.",
+    )
+    args = parser.parse_args()
+
+    for path in args.journals or sorted(DATA_DIR.glob("*.journal")):
+        print(f"Recovering {path}...")
+        metadata = recover_session(path)
+        print(
+            f"Recovered {metadata['filename']}: {metadata['num_samples']} samples, "
+            f"{metadata['num_markers']} markers, {metadata['num_pauses']} pauses"
+        )
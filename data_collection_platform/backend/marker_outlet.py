@@ -1,9 +1,23 @@
 from constants import *
 import pylsl
 import logging
+import threading
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
+MARKER_STREAM_NAME = "Neurotech markers"
+"""Name of the marker stream published by MarkerOutlet
+"""
+
+MARKER_SOURCE_ID = "data-collection-markers"
+"""Source id of the marker stream published by MarkerOutlet, used to select it among other marker streams
+"""
+
+FLUSH_TIMEOUT = 1.0
+"""Seconds MarkerOutlet.flush() waits for the queued markers to be pushed
+"""
+
 
 def decode_status(status: int) -> str:
     """Decode a marker from the LSL stream."""
@@ -24,25 +38,144 @@ def decode_status(status: int) -> str:
         return "UNKNOWN"
 
 
+def decode_event(event: int) -> str:
+    """Decode the event code of an event marker (has_new_status == IS_EVENT)."""
+
+    if event == EVENT_CHECKPOINT:
+        return "checkpoint"
+    elif event == EVENT_STOP:
+        return "stop"
+    else:
+        return "UNKNOWN"
+
+
 class MarkerOutlet:
-    """This class creates and sends markers to an LSL stream."""
+    """This class creates and sends markers to an LSL stream.
+
+    Markers are stamped with local_clock() when they are sent and queued.
+    A background thread pushes them, so sending never blocks the caller on
+    LSL. Markers that pile up between two wakeups of the thread are pushed
+    with one push_chunk.
+
+    With sync_to_flip, markers are held until the UI calls on_flip() right
+    after the display flip that presents the stage they belong to, and are
+    stamped with the local_clock() time of that flip. The UI must make the
+    stage change and the send atomic with respect to its draw and flip, so
+    a marker is never stamped with a flip that still showed the old stage.
+    """
 
-    def __init__(self):
+    def __init__(self, sync_to_flip=False):
+        """Create the marker stream and start its push thread.
+
+        Args:
+            sync_to_flip (bool, optional): Hold markers until on_flip() instead of queueing
+                them as they are sent. Defaults to False.
+        """
         info = pylsl.StreamInfo(
-            "Neurotech markers", "Markers", 4, 0, "int32", "data-collection-markers"
+            MARKER_STREAM_NAME, "Markers", MARKER_CHANNELS, 0, "int32", MARKER_SOURCE_ID
         )
         self.outlet = pylsl.StreamOutlet(info)
+        self.sync_to_flip = sync_to_flip
+        self.held = []
+        self.lock = threading.Lock()
+
+        # deque appends and pops are atomic, so senders never wait on the push thread
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.pushed = threading.Condition()
+        self.pushing = False
+        self.running = True
+        self.thread = threading.Thread(
+            target=self._push_worker, name="marker-outlet", daemon=True
+        )
+        self.thread.start()
 
     def send(self, new_image=None, new_status=None):
-        """Send a marker to the LSL stream."""
+        """Send a marker to the LSL stream, or hold it until the next flip with sync_to_flip."""
         sample = [
             SHOULD_UPDATE if new_image is not None else NO_UPDATE,
             new_image if new_image is not None else IMAGE_NONE,
             SHOULD_UPDATE if new_status is not None else NO_UPDATE,
             new_status if new_status is not None else NO_UPDATE,
         ]
-        self.outlet.push_sample(sample)
-        logger.debug(f"Sent update: {sample}")
+        self._send(sample, hold=self.sync_to_flip)
+
+    def send_event(self, event, hold=None):
+        """Send an event marker, which does not change the status or image labels.
+
+        Args:
+            event (int): EVENT_CHECKPOINT or EVENT_STOP.
+            hold (bool, optional): Hold the marker until the next flip. Defaults to sync_to_flip.
+        """
+        sample = [NO_UPDATE, IMAGE_NONE, IS_EVENT, event]
+        self._send(sample, hold=self.sync_to_flip if hold is None else hold)
+
+    def _send(self, sample, hold):
+        if hold:
+            with self.lock:
+                self.held.append(sample)
+            logger.debug(f"Held update until the next flip: {sample}")
+            return
+        self.queue.append((sample, pylsl.local_clock()))
+        self.wakeup.set()
+
+    def on_flip(self, timestamp=None):
+        """Queue the markers held since the last flip, stamped with the time of this flip.
+
+        Call right after pygame.display.flip() returns.
+
+        Args:
+            timestamp (float, optional): local_clock() time of the flip. Defaults to now.
+        """
+        if timestamp is None:
+            timestamp = pylsl.local_clock()
+        with self.lock:
+            held, self.held = self.held, []
+        if held:
+            self.queue.extend((sample, timestamp) for sample in held)
+            self.wakeup.set()
+
+    def _push_worker(self):
+        while True:
+            self.wakeup.wait()
+            # Cleared before draining, so a marker queued during the drain wakes the next round
+            self.wakeup.clear()
+            with self.pushed:
+                self.pushing = True
+
+            batch = []
+            while self.queue:
+                batch.append(self.queue.popleft())
+            if len(batch) == 1:
+                self.outlet.push_sample(*batch[0])
+            elif batch:
+                samples, timestamps = zip(*batch)
+                self.outlet.push_chunk(list(samples), list(timestamps))
+            for sample, timestamp in batch:
+                logger.debug(f"Sent update at {timestamp:.4f}: {sample}")
+
+            with self.pushed:
+                self.pushing = False
+                self.pushed.notify_all()
+            if not self.running and not self.queue:
+                return
+
+    def flush(self, timeout=FLUSH_TIMEOUT) -> bool:
+        """Block until every queued marker has been pushed. Held markers are not queued yet.
+
+        Returns:
+            bool: False if the timeout expired first.
+        """
+        with self.pushed:
+            return self.pushed.wait_for(
+                lambda: not self.queue and not self.pushing, timeout
+            )
+
+    def close(self):
+        """Push the queued markers and stop the push thread."""
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
 
     def send_new_image(self, new_image):
         """Send a new image marker to the LSL stream."""
@@ -54,8 +187,8 @@ class MarkerOutlet:
 
     def send_checkpoint_marker(self):
         """Send checkpoint marker at the end of each cycle."""
-        self.send_marker(999)  # Unique marker for checkpoints
+        self.send_event(EVENT_CHECKPOINT)
 
     def send_stop_marker(self):
-        """Send stop marker when session ends."""
-        self.send_marker(0)  # Marker 0 indicates session stopped
+        """Send stop marker when session ends. It is never held, as the UI may be closing."""
+        self.send_event(EVENT_STOP, hold=False)
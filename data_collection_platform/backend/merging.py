@@ -0,0 +1,221 @@
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+
+def forward_fill_markers(
+    eeg_timestamps: np.ndarray,
+    marker_timestamps: np.ndarray,
+    marker_values: np.ndarray,
+    initial,
+) -> np.ndarray:
+    """Carry marker values forward over the EEG timeline.
+
+    Each marker is placed on the first EEG sample with a strictly greater
+    timestamp with one searchsorted over the EEG timestamps, then its value
+    is carried forward until the next marker. If several markers land on the
+    same sample, the last one wins. Markers after the last sample are ignored.
+
+    Args:
+        eeg_timestamps (np.ndarray): Sorted EEG sample timestamps.
+        marker_timestamps (np.ndarray): Marker timestamps, in the order received.
+        marker_values (np.ndarray): Value carried by each marker.
+        initial: Value for samples before the first marker.
+
+    Returns:
+        np.ndarray: One value per EEG sample.
+    """
+    n = len(eeg_timestamps)
+    positions = np.searchsorted(eeg_timestamps, marker_timestamps, side="right")
+    in_range = positions < n
+
+    latest_marker = np.full(n, -1, dtype=np.int64)
+    np.maximum.at(latest_marker, positions[in_range], np.flatnonzero(in_range))
+    latest_marker = np.maximum.accumulate(latest_marker) if n else latest_marker
+
+    values = np.full(n, initial, dtype=np.int64)
+    has_marker = latest_marker >= 0
+    values[has_marker] = np.asarray(marker_values)[latest_marker[has_marker]]
+    return values
+
+
+def add_label_columns(merged: pd.DataFrame, num_imgs: int):
+    """Add the one-hot status and image columns to a merged frame, in place."""
+    merged["transition"] = (merged["status"] == STATUS_TRANSITION).astype(int)
+    merged["baseline"] = (merged["status"] == STATUS_BASELINE).astype(int)
+    merged["imagine"] = (merged["status"] == STATUS_IMAGINE).astype(int)
+    merged["look"] = (merged["status"] == STATUS_LOOK).astype(int)
+    merged["imagine_eyes_closed"] = (
+        merged["status"] == STATUS_IMAGINE_EYES_CLOSED
+    ).astype(int)
+    merged["done"] = (merged["status"] == STATUS_DONE).astype(int)
+
+    for i in range(num_imgs):
+        merged[f"image_{i}"] = (merged["image_id"] == i).astype(int)
+    merged["image_none"] = (merged["image_id"] == IMAGE_NONE).astype(int)
+
+
+def correct_timestamps(timestamps: np.ndarray, clock_offsets: np.ndarray) -> np.ndarray:
+    """Map timestamps of a stream's clock to the local clock.
+
+    The offset at each timestamp is interpolated linearly between the
+    time_correction() offsets captured during the recording, and held
+    constant before the first and after the last capture.
+
+    Args:
+        timestamps (np.ndarray): Timestamps in the stream's clock.
+        clock_offsets (np.ndarray): (captures x 2) local capture time and offset of the stream.
+
+    Returns:
+        np.ndarray: Timestamps in the local clock.
+    """
+    if len(clock_offsets) == 0:
+        return timestamps
+    local_times, offsets = clock_offsets[:, 0], clock_offsets[:, 1]
+    return timestamps + np.interp(timestamps, local_times - offsets, offsets)
+
+
+def marker_onsets(eeg_timestamps: np.ndarray, marker_timestamps: np.ndarray, first_index=0):
+    """Place markers on the EEG timeline as fractional sample indices.
+
+    Args:
+        eeg_timestamps (np.ndarray): Sorted EEG sample timestamps.
+        marker_timestamps (np.ndarray): Marker timestamps.
+        first_index (int, optional): Sample index of eeg_timestamps[0]. Defaults to 0.
+
+    Returns:
+        np.ndarray: Fractional sample index of each marker, e.g. 10.25 for a marker a
+            quarter of the way from sample 10 to sample 11. Markers outside the EEG
+            timestamps are clamped to the first or last sample.
+    """
+    return np.interp(
+        marker_timestamps,
+        eeg_timestamps,
+        np.arange(first_index, first_index + len(eeg_timestamps), dtype=np.float64),
+    )
+
+
+class StreamingMerger:
+    """Labels EEG blocks with status and image as they are flushed.
+
+    Produces the same rows as CSVDataRecorder.merge_eeg_and_marker_dfs over the
+    whole session, one block at a time, plus the fractional sample index of
+    every marker. The current status and image, the running sample index and
+    any markers newer than the last EEG sample seen so far are carried across
+    block boundaries. Blocks must be passed in recording order.
+
+    If clock_offsets is given, the blocks hold raw stream timestamps and are
+    mapped to the local clock with correct_timestamps before markers are
+    placed. clock_offsets is a list of (local_time, eeg_offset, marker_offset)
+    time_correction() captures. It may keep growing while the session is
+    merged, and each block uses the captures available when it is labelled.
+    """
+
+    def __init__(self, channel_names, num_imgs=20, clock_offsets=None):
+        self.channel_names = list(channel_names)
+        self.num_imgs = num_imgs
+        self.clock_offsets = clock_offsets
+        self.status = STATUS_TRANSITION
+        self.image_id = IMAGE_NONE
+        self.num_samples = 0
+        self.last_timestamp = None
+        self.pending_markers = np.empty((0, 1 + MARKER_CHANNELS))
+        self.timestamps = np.empty(0)
+        self.marker_onsets = np.empty(0)
+        self.marker_rows = np.empty(0, dtype=np.int64)
+
+    def _correct(self, timestamps: np.ndarray, column) -> np.ndarray:
+        if self.clock_offsets is None:
+            return timestamps
+        offsets = np.array(self.clock_offsets, dtype=np.float64).reshape(-1, 3)
+        return correct_timestamps(timestamps, offsets[:, [0, column]])
+
+    def label_block(self, eeg_block: np.ndarray, marker_block: np.ndarray):
+        """Compute the status and image_id of every sample in one block of EEG samples.
+
+        Args:
+            eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+            marker_block (np.ndarray): (markers x 5) array received with the block, timestamp first.
+
+        Returns:
+            tuple: status and image_id, one value per sample. The timestamps used for
+                labelling (corrected if clock_offsets is set), and the fractional sample
+                index and block row of every marker placed in this block, are left in
+                the timestamps, marker_onsets and marker_rows attributes.
+        """
+        eeg_timestamps = self._correct(eeg_block[:, 0], 1)
+        if self.clock_offsets is not None and len(marker_block):
+            marker_block = marker_block.copy()
+            marker_block[:, 0] = self._correct(marker_block[:, 0], 2)
+        markers = np.concatenate([self.pending_markers, marker_block])
+
+        # Markers at or after the last sample apply to a later block
+        if len(eeg_timestamps):
+            placed = markers[:, 0] < eeg_timestamps[-1]
+        else:
+            placed = np.zeros(len(markers), dtype=bool)
+        self.pending_markers = markers[~placed]
+        markers = markers[placed]
+
+        # Markers between the previous block and this one are interpolated across the gap
+        if self.last_timestamp is not None:
+            onset_timestamps = np.concatenate([[self.last_timestamp], eeg_timestamps])
+            first_index = self.num_samples - 1
+        else:
+            onset_timestamps, first_index = eeg_timestamps, self.num_samples
+        self.timestamps = eeg_timestamps
+        self.marker_onsets = (
+            marker_onsets(onset_timestamps, markers[:, 0], first_index)
+            if len(eeg_timestamps)
+            else np.empty(0)
+        )
+        self.marker_rows = np.searchsorted(eeg_timestamps, markers[:, 0], side="right")
+
+        image_rows = markers[markers[:, 1] == SHOULD_UPDATE]
+        status_rows = markers[markers[:, 3] == SHOULD_UPDATE]
+
+        status = forward_fill_markers(
+            eeg_timestamps, status_rows[:, 0], status_rows[:, 4], self.status
+        )
+        image_id = forward_fill_markers(
+            eeg_timestamps, image_rows[:, 0], image_rows[:, 2], self.image_id
+        )
+
+        if len(status_rows):
+            self.status = int(status_rows[-1, 4])
+        if len(image_rows):
+            self.image_id = int(image_rows[-1, 2])
+        if len(eeg_timestamps):
+            self.last_timestamp = eeg_timestamps[-1]
+        self.num_samples += len(eeg_timestamps)
+
+        return status, image_id
+
+    def merge_block(self, eeg_block: np.ndarray, marker_block: np.ndarray) -> pd.DataFrame:
+        """Label one block of EEG samples.
+
+        Args:
+            eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+            marker_block (np.ndarray): (markers x 5) array received with the block, timestamp first.
+
+        Returns:
+            pd.DataFrame: The block in the merged file layout. marker_onset holds the
+                fractional sample index of the marker that takes effect on a sample, and
+                is NaN on samples without a marker. If several markers take effect on the
+                same sample, the last one is kept.
+        """
+        first_index = self.num_samples
+        status, image_id = self.label_block(eeg_block, marker_block)
+
+        merged = pd.DataFrame(eeg_block, columns=["timestamp"] + self.channel_names)
+        merged["timestamp"] = self.timestamps
+        merged.insert(0, "index", np.arange(first_index, first_index + len(merged)))
+        merged["status"] = status
+        merged["image_id"] = image_id
+        onsets = np.full(len(merged), np.nan)
+        onsets[self.marker_rows] = self.marker_onsets
+        merged["marker_onset"] = onsets
+        add_label_columns(merged, self.num_imgs)
+
+        return merged
@@ -0,0 +1,216 @@
+import json
+import threading
+
+import numpy as np
+
+HISTOGRAM_BINS = 100
+"""Number of bins of every recorder metric histogram
+"""
+
+RATE_WINDOW = 1.0
+"""Seconds of EEG timestamps over which one effective sample rate is measured
+"""
+
+MARKER_DELAY_RANGE = (-0.5, 0.5)
+"""Range in seconds of the marker-to-sample delay histogram
+"""
+
+PENDING_SAMPLES = 64
+"""Number of timestamps observed one at a time before they are added to the histograms in bulk
+"""
+
+
+class StreamingHistogram:
+    """Fixed-bin histogram updated in bulk, with exact count, mean, std, min and max.
+
+    Values outside [low, high) are counted in an underflow and an overflow
+    bin, so nothing is lost. Quantiles are interpolated within a bin.
+    """
+
+    def __init__(self, low, high, bins=HISTOGRAM_BINS):
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+        bins = np.searchsorted(self.edges, values, side="right")
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        self.count += len(values)
+        self.total += values.sum()
+        self.total_sq += np.square(values).sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+    def quantile(self, q):
+        """Estimate the q-th quantile (0 <= q <= 1) from the bins."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = np.cumsum(self.counts)
+        i = int(np.searchsorted(cumulative, rank, side="left"))
+        if i == 0:
+            return float(self.min)
+        if i == len(self.counts) - 1:
+            return float(self.max)
+        low, high = self.edges[i - 1], self.edges[i]
+        in_bin = self.counts[i]
+        fraction = (rank - (cumulative[i] - in_bin)) / in_bin if in_bin else 0.0
+        return float(np.clip(low + fraction * (high - low), self.min, self.max))
+
+    def summary(self, include_bins=False) -> dict:
+        """Return the count, mean, std, min, max and p50/p95/p99 of the values added so far.
+
+        Args:
+            include_bins (bool, optional): Also return the bin edges and counts, the
+                first and last count being the underflow and overflow. Defaults to False.
+        """
+        summary = {"count": self.count}
+        if self.count:
+            mean = self.total / self.count
+            summary.update(
+                mean=mean,
+                std=float(np.sqrt(max(self.total_sq / self.count - mean**2, 0.0))),
+                min=float(self.min),
+                max=float(self.max),
+                p50=self.quantile(0.5),
+                p95=self.quantile(0.95),
+                p99=self.quantile(0.99),
+            )
+        if include_bins:
+            summary.update(edges=self.edges.tolist(), counts=self.counts.tolist())
+        return summary
+
+
+class RecorderMetrics:
+    """Timing metrics of one recording, updated by the worker and queryable while it runs.
+
+    Only the recording worker may call the observe_* methods, restart_timeline
+    and flush. summary() can be called from any thread.
+
+    Tracks:
+        sample_interval: Seconds between consecutive EEG timestamps (jitter).
+        sample_rate: Effective EEG rate in Hz over windows of RATE_WINDOW seconds.
+        marker_delay: Seconds between a marker's timestamp and the newest EEG timestamp
+            when the marker was pulled. Positive means the marker arrived after the EEG
+            it labels.
+        marker_collisions: Markers less than one nominal sample interval after the
+            previous marker, i.e. markers that land on the same EEG sample.
+    """
+
+    def __init__(self, nominal_srate):
+        self.nominal_srate = nominal_srate
+        period = 1 / nominal_srate if nominal_srate > 0 else 0.0
+
+        self.lock = threading.Lock()
+        self.sample_interval = StreamingHistogram(0.0, 4 * period if period else 0.1)
+        self.sample_rate = StreamingHistogram(
+            0.0, 2 * nominal_srate if nominal_srate > 0 else 1000.0
+        )
+        self.marker_delay = StreamingHistogram(*MARKER_DELAY_RANGE)
+        self.period = period
+        self.num_samples = 0
+        self.num_markers = 0
+        self.marker_collisions = 0
+        self.last_timestamp = None
+        self.last_marker_timestamp = None
+        self.window_start = None
+        self.window_samples = 0
+        self.pending = []
+
+    def observe_sample(self, timestamp):
+        """Record one EEG timestamp. Timestamps are added to the histograms in bulk."""
+        self.pending.append(timestamp)
+        if len(self.pending) >= PENDING_SAMPLES:
+            self.flush()
+
+    def observe_samples(self, timestamps):
+        """Record a chunk of EEG timestamps, in order."""
+        self.flush()
+        self._add_samples(np.asarray(timestamps, dtype=np.float64))
+
+    def observe_marker(self, marker_timestamp, latest_eeg_timestamp):
+        """Record a marker pulled when latest_eeg_timestamp was the newest EEG timestamp."""
+        with self.lock:
+            if latest_eeg_timestamp is not None:
+                self.marker_delay.add(latest_eeg_timestamp - marker_timestamp)
+            if (
+                self.last_marker_timestamp is not None
+                and marker_timestamp - self.last_marker_timestamp < self.period
+            ):
+                self.marker_collisions += 1
+            self.last_marker_timestamp = marker_timestamp
+            self.num_markers += 1
+
+    def restart_timeline(self):
+        """Start a new run of samples, e.g. after a pause, so the gap is not counted as jitter."""
+        self.flush()
+        with self.lock:
+            self.last_timestamp = None
+            self.window_start = None
+            self.window_samples = 0
+
+    def flush(self):
+        """Add the timestamps observed one at a time to the histograms."""
+        if self.pending:
+            timestamps = np.array(self.pending, dtype=np.float64)
+            self.pending = []
+            self._add_samples(timestamps)
+
+    def _add_samples(self, timestamps: np.ndarray):
+        if len(timestamps) == 0:
+            return
+        with self.lock:
+            if self.last_timestamp is not None:
+                self.sample_interval.add(np.diff(timestamps, prepend=self.last_timestamp))
+            else:
+                self.sample_interval.add(np.diff(timestamps))
+                self.window_start = timestamps[0]
+                self.window_samples = -1
+
+            self.window_samples += len(timestamps)
+            if timestamps[-1] - self.window_start >= RATE_WINDOW:
+                self.sample_rate.add(
+                    self.window_samples / (timestamps[-1] - self.window_start)
+                )
+                self.window_start = timestamps[-1]
+                self.window_samples = 0
+
+            self.last_timestamp = timestamps[-1]
+            self.num_samples += len(timestamps)
+
+    def summary(self, include_bins=False) -> dict:
+        """Return a snapshot of every metric.
+
+        Args:
+            include_bins (bool, optional): Include the histogram bins. Defaults to False.
+
+        Returns:
+            dict: Sample and marker counts, marker collisions, nominal sample rate,
+                effective sample rate over the whole recording excluding pauses, and a
+                summary of every histogram.
+        """
+        with self.lock:
+            # Pauses are not intervals, so this is the rate while recording
+            span = self.sample_interval.total
+            return {
+                "num_samples": self.num_samples,
+                "num_markers": self.num_markers,
+                "marker_collisions": self.marker_collisions,
+                "nominal_srate": self.nominal_srate,
+                "effective_srate": self.sample_interval.count / span if span > 0 else None,
+                "sample_interval": self.sample_interval.summary(include_bins),
+                "sample_rate": self.sample_rate.summary(include_bins),
+                "marker_delay": self.marker_delay.summary(include_bins),
+            }
+
+    def write(self, path):
+        """Write the summary, including the histogram bins, to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.summary(include_bins=True), f, indent=2)
@@ -0,0 +1,486 @@
+import argparse
+import threading
+import time
+import uuid
+import logging
+
+import numpy as np
+import pandas as pd
+import pylsl
+
+from pathlib import Path
+
+from constants import *
+from backend import compression
+from backend.storage import DATA_DIR, CONVERT_BLOCK_SIZE
+from backend.session_reader import SessionReader
+from backend.epoching import find_session
+from backend.marker_outlet import MARKER_STREAM_NAME, MARKER_SOURCE_ID
+
+logger = logging.getLogger(__name__)
+
+REPLAY_TICK = 0.002
+"""Minimum seconds between two pushes of the replay, samples due in between are pushed as one chunk
+"""
+
+STOP_CHECK_INTERVAL = 0.1
+"""Maximum seconds the replay sleeps before checking whether it was stopped
+"""
+
+MAX_GAP_PERIODS = 5
+"""Sample periods between two samples above which the replay treats the interval as a gap, e.g. a pause, and skips it
+"""
+
+MARKER_COLUMNS = ["timestamp", "has_new_image", "new_image", "has_new_status", "new_status"]
+"""Columns of a marker row, timestamp first, in the order of the marker stream's channels
+"""
+
+
+def _find_pair(session):
+    """Return the eeg_ and markers_ CSV paths of a session, or None if it has no such pair."""
+    path = Path(session)
+    for directory in [path.parent, DATA_DIR]:
+        eeg_path = directory / f"eeg_{path.name}"
+        marker_path = directory / f"markers_{path.name}"
+        if eeg_path.exists() and marker_path.exists():
+            return eeg_path, marker_path
+    return None
+
+
+def _markers_from_labels(timestamps, status, image_id, previous, srate=0.0):
+    """Rebuild the markers of a merged block from the changes of its status and image_id.
+
+    Each marker is stamped just before the changed sample, half a sample
+    period or halfway to the sample before it, whichever is closer, so it
+    stays next to the changed sample after a gap such as a pause.
+
+    Args:
+        timestamps (np.ndarray): Sample timestamps of the block.
+        status (np.ndarray): Status of every sample.
+        image_id (np.ndarray): Image id of every sample.
+        previous (tuple): Timestamp, status and image_id of the last sample of the previous block.
+        srate (float, optional): Nominal sample rate of the session, 0 if unknown, in which case
+            markers are stamped halfway between the two samples. Defaults to 0.
+
+    Returns:
+        np.ndarray: (markers x 5) marker rows, timestamp first.
+    """
+    previous_timestamp, previous_status, previous_image = previous
+    gaps = timestamps - np.concatenate([[previous_timestamp], timestamps[:-1]])
+    marker_times = timestamps - (0.5 * gaps if srate <= 0 else np.minimum(0.5 * gaps, 0.5 / srate))
+    new_status = status != np.concatenate([[previous_status], status[:-1]])
+    new_image = image_id != np.concatenate([[previous_image], image_id[:-1]])
+    changed = new_status | new_image
+
+    return np.column_stack(
+        [
+            marker_times[changed],
+            np.where(new_image[changed], SHOULD_UPDATE, NO_UPDATE),
+            np.where(new_image[changed], image_id[changed], IMAGE_NONE),
+            np.where(new_status[changed], SHOULD_UPDATE, NO_UPDATE),
+            np.where(new_status[changed], status[changed], NO_UPDATE),
+        ]
+    ).astype(np.float64)
+
+
+def _skip_gaps(timestamps, marker_timestamps, previous, skipped, period):
+    """Shift a block onto the session timeline without its gaps, such as pauses.
+
+    Every interval longer than MAX_GAP_PERIODS periods is shortened to one
+    period. A marker inside a gap is kept half a period before the sample
+    ending the gap.
+
+    Args:
+        timestamps (np.ndarray): Sample timestamps of the block.
+        marker_timestamps (np.ndarray): Marker timestamps of the block.
+        previous (float): Timestamp of the last sample before the block.
+        skipped (float): Seconds skipped before the block.
+        period (float): Nominal sample period of the session.
+
+    Returns:
+        tuple: Shifted sample timestamps, shifted marker timestamps and the seconds skipped
+            up to the end of the block.
+    """
+    times = np.concatenate([[previous], timestamps])
+    intervals = np.diff(times)
+    gap = intervals > MAX_GAP_PERIODS * period
+    offsets = skipped + np.concatenate([[0.0], np.cumsum(np.where(gap, intervals - period, 0.0))])
+    shifted = times - offsets
+
+    before = np.maximum(np.searchsorted(times, marker_timestamps, side="right") - 1, 0)
+    marker_times = marker_timestamps - offsets[before]
+    in_gap = before < len(gap)
+    in_gap[in_gap] = gap[before[in_gap]]
+    marker_times[in_gap] = np.minimum(
+        marker_times[in_gap], shifted[before[in_gap] + 1] - 0.5 * period
+    )
+    return shifted[1:], marker_times, offsets[-1]
+
+
+def iter_session_blocks(session, use_merged=False, block_size=CONVERT_BLOCK_SIZE):
+    """Read a recorded session as blocks of EEG samples and the markers between them, in constant memory.
+
+    Sessions are read from their eeg_/markers_ CSV pair if it exists, and
+    otherwise from their merged CSV, npy directory or .eegz file. Markers are
+    only recorded as status and image_id in a merged CSV, so they are rebuilt
+    from the changes of those columns.
+
+    Args:
+        session (str or Path): Name the session was recorded under (e.g. "03-14_10-00-00.csv")
+            or the path to one of its files.
+        use_merged (bool, optional): Read the merged CSV even if the eeg_/markers_ pair exists.
+            Defaults to False.
+        block_size (int, optional): EEG samples per block. Defaults to CONVERT_BLOCK_SIZE.
+
+    Yields:
+        tuple: channel names, (samples x 1 + channels) EEG block and (markers x 5) marker block,
+            both timestamp first. The markers of a block fall before its last sample, markers
+            after the last sample of the session come in a last block without samples.
+    """
+    pair = None if use_merged else _find_pair(session)
+
+    if pair is not None:
+        eeg_path, marker_path = pair
+        channel_names = [c for c in pd.read_csv(eeg_path, nrows=0).columns if c != "timestamp"]
+        # Markers are few, so they are read in full and sliced per block
+        markers = pd.read_csv(marker_path, float_precision="round_trip")[MARKER_COLUMNS]
+        markers = markers.to_numpy(dtype=np.float64)
+        marker_start = 0
+        for eeg_df in pd.read_csv(
+            eeg_path, chunksize=block_size, float_precision="round_trip"
+        ):
+            eeg_block = eeg_df[["timestamp"] + channel_names].to_numpy(dtype=np.float64)
+            if not len(eeg_block):
+                continue
+            marker_end = np.searchsorted(markers[:, 0], eeg_block[-1, 0])
+            yield channel_names, eeg_block, markers[marker_start:marker_end]
+            marker_start = marker_end
+        if marker_start < len(markers):
+            # Markers at or after the last sample, such as the stop marker
+            yield channel_names, np.empty((0, 1 + len(channel_names))), markers[marker_start:]
+        return
+
+    kind, path = find_session(session)
+
+    if kind == "npy":
+        reader = SessionReader(path)
+        marker_start = 0
+        for start in range(0, len(reader), block_size):
+            eeg_block = np.column_stack(
+                [reader.timestamps[start : start + block_size], reader.channels[start : start + block_size]]
+            ).astype(np.float64)
+            marker_end = np.searchsorted(reader.marker_timestamps, eeg_block[-1, 0])
+            marker_block = np.column_stack(
+                [reader.marker_timestamps[marker_start:marker_end], reader.markers[marker_start:marker_end]]
+            ).astype(np.float64)
+            yield reader.channel_names, eeg_block, marker_block
+            marker_start = marker_end
+        if marker_start < len(reader.marker_timestamps):
+            marker_block = np.column_stack(
+                [reader.marker_timestamps[marker_start:], reader.markers[marker_start:]]
+            ).astype(np.float64)
+            yield reader.channel_names, np.empty((0, 1 + len(reader.channel_names))), marker_block
+
+    elif kind == "eegz":
+        channel_names = compression.read_metadata(path)["channels"]
+        for block in compression.iter_blocks(path):
+            eeg_block = np.column_stack([block["timestamps"], block["channels"]])
+            yield channel_names, eeg_block.astype(np.float64), block["markers"]
+
+    else:
+        header = pd.read_csv(path, nrows=0).columns
+        channel_names = [
+            c for c in header[: header.get_loc("status")] if c not in ("index", "timestamp")
+        ]
+        previous = None
+        srate = 0.0
+        for merged in pd.read_csv(
+            path,
+            usecols=["timestamp"] + channel_names + ["status", "image_id"],
+            chunksize=block_size,
+            float_precision="round_trip",
+        ):
+            if not len(merged):
+                continue
+            timestamps = merged["timestamp"].to_numpy()
+            status = merged["status"].to_numpy()
+            image_id = merged["image_id"].to_numpy()
+            if previous is None:
+                first_interval = timestamps[1] - timestamps[0] if len(timestamps) > 1 else 0.0
+                previous = (timestamps[0] - first_interval, STATUS_TRANSITION, IMAGE_NONE)
+                srate = estimate_srate(timestamps)
+            eeg_block = merged[["timestamp"] + channel_names].to_numpy(dtype=np.float64)
+            yield channel_names, eeg_block, _markers_from_labels(
+                timestamps, status, image_id, previous, srate
+            )
+            previous = (timestamps[-1], status[-1], image_id[-1])
+
+
+def estimate_srate(timestamps: np.ndarray) -> float:
+    """Estimate the nominal sample rate of recorded timestamps from their median interval."""
+    intervals = np.diff(timestamps)
+    intervals = intervals[intervals > 0]
+    return float(np.round(1 / np.median(intervals))) if len(intervals) else 0.0
+
+
+class SessionReplay:
+    """Re-streams a recorded session over LSL with its original relative timing.
+
+    Publishes an EEG outlet with the session's channel labels and a marker
+    outlet like MarkerOutlet's, so the recorder, the live classifier or anything else
+    that consumes the platform's streams can be run without hardware. The
+    session is read block by block with iter_session_blocks, so long sessions
+    replay in constant memory.
+
+    Every sample and marker is pushed when its place on the session timeline
+    is reached and carries the matching LSL timestamp, so the EEG and the
+    markers keep their recorded offsets. At speed N the timeline runs N times
+    faster and the EEG stream advertises N times its recorded rate.
+
+    Gaps in the EEG, where the recording was paused, are skipped. The EEG
+    stream advertises a regular rate, and a consumer that dejitters it, like
+    the recorder, would close a gap by shifting the samples after it towards
+    the ones before it for a long time, moving them away from their markers.
+
+    Example:
+        replay = SessionReplay("03-14_10-00-00.csv", speed=10)
+        replay.start()
+        ...
+        replay.wait()
+    """
+
+    def __init__(self, session, speed=1.0, use_merged=False, srate=None):
+        """Read the first block of a session and create its outlets.
+
+        Args:
+            session (str or Path): Name the session was recorded under or the path to one of its files.
+            speed (float, optional): Replay speed, 1 for real time. Defaults to 1.
+            use_merged (bool, optional): Replay the merged CSV even if the eeg_/markers_ pair
+                exists. Defaults to False.
+            srate (float, optional): Recorded sample rate. Estimated from the timestamps by default.
+
+        Raises:
+            ValueError: If speed is not positive or the session has no EEG samples.
+        """
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        self.session = session
+        self.speed = speed
+        self.use_merged = use_merged
+
+        first_block = None
+        for channel_names, eeg_block, _ in iter_session_blocks(session, use_merged):
+            if len(eeg_block):
+                first_block = eeg_block
+                break
+        if first_block is None:
+            raise ValueError(f"Session {session} has no samples to replay")
+        self.channel_names = list(channel_names)
+        self.srate = srate or estimate_srate(first_block[:, 0])
+        self.first_timestamp = first_block[0, 0]
+
+        self.source_id = f"replay-{Path(session).stem}-{uuid.uuid4()}"
+        info = pylsl.StreamInfo(
+            f"Replay {Path(session).stem}",
+            "EEG",
+            len(self.channel_names),
+            self.srate * speed,
+            "float32",
+            self.source_id,
+        )
+        channels = info.desc().append_child("channels")
+        for name in self.channel_names:
+            channels.append_child("channel").append_child_value("label", name)
+        self.eeg_outlet = pylsl.StreamOutlet(info)
+        # Replayed markers carry their own timestamps and are pushed in order with the
+        # EEG, so they bypass MarkerOutlet's queue and push thread
+        self.marker_outlet = pylsl.StreamOutlet(
+            pylsl.StreamInfo(
+                MARKER_STREAM_NAME, "Markers", MARKER_CHANNELS, 0, "int32", MARKER_SOURCE_ID
+            )
+        )
+
+        self.samples_pushed = 0
+        self.markers_pushed = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Replay the session from a background thread."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the replay and wait for it to finish."""
+        self.running = False
+        self.wait()
+
+    def wait(self):
+        """Block until the whole session has been replayed or stop() is called."""
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """Replay the session in the calling thread, returning when it has been replayed."""
+        self.running = True
+        start_clock = pylsl.local_clock()
+        # Without a sample rate, intervals cannot be told apart from gaps
+        period = 1 / self.srate if self.srate > 0 else np.inf
+        previous, skipped = self.first_timestamp, 0.0
+
+        def replay_time(timestamps):
+            return start_clock + (timestamps - self.first_timestamp) / self.speed
+
+        for _, eeg_block, marker_block in iter_session_blocks(self.session, self.use_merged):
+            eeg_timestamps, marker_timestamps, skipped = _skip_gaps(
+                eeg_block[:, 0], marker_block[:, 0], previous, skipped, period
+            )
+            if len(eeg_block):
+                previous = eeg_block[-1, 0]
+            eeg_times = replay_time(eeg_timestamps)
+            marker_times = replay_time(marker_timestamps)
+            samples = np.ascontiguousarray(eeg_block[:, 1:], dtype=np.float32)
+            markers = marker_block[:, 1:].astype(np.int32)
+
+            eeg_start = marker_start = 0
+            while self.running and (
+                eeg_start < len(eeg_times) or marker_start < len(marker_times)
+            ):
+                now = pylsl.local_clock()
+                eeg_end = np.searchsorted(eeg_times, now, side="right")
+                marker_end = np.searchsorted(marker_times, now, side="right")
+
+                # Markers first, so a marker never reaches a consumer after the samples it precedes
+                for i in range(marker_start, marker_end):
+                    self.marker_outlet.push_sample(
+                        markers[i].tolist(), marker_times[i]
+                    )
+                if eeg_end > eeg_start:
+                    self.eeg_outlet.push_chunk(
+                        samples[eeg_start:eeg_end], eeg_times[eeg_start:eeg_end].tolist()
+                    )
+                self.samples_pushed += eeg_end - eeg_start
+                self.markers_pushed += marker_end - marker_start
+                eeg_start, marker_start = eeg_end, marker_end
+
+                next_times = []
+                if eeg_start < len(eeg_times):
+                    next_times.append(eeg_times[eeg_start])
+                if marker_start < len(marker_times):
+                    next_times.append(marker_times[marker_start])
+                if next_times:
+                    time.sleep(
+                        min(
+                            max(min(next_times) - pylsl.local_clock(), REPLAY_TICK),
+                            STOP_CHECK_INTERVAL,
+                        )
+                    )
+
+            if not self.running:
+                break
+
+        self.running = False
+        logger.info(
+            f"Replayed {self.samples_pushed} samples and {self.markers_pushed} markers of {self.session}"
+        )
+
+
+def test_replay_merged_session_with_pause(speed=10.0, srate=250.0, seed=0):
+    """Replay a merged CSV with a pause, record the replay and check every sample keeps its labels.
+
+    The session changes status and image every second, including on the
+    first sample after a 1 s pause, like every pause at the end of a cycle.
+    The replay is recorded with CSVDataRecorder, which dejitters the
+    timestamps, and the labels are compared by a sample counter in channel 0.
+    """
+    import shutil
+    import tempfile
+
+    from backend.csv_data_recorder import CSVDataRecorder
+    from backend.discovery import StreamQuery
+    from backend.epoching import load_session_columns
+
+    rng = np.random.default_rng(seed)
+    run_length = int(srate)
+    runs = 8
+    counter = np.arange(runs * run_length)
+    timestamps = 1000.0 + counter / srate
+    timestamps[counter >= runs // 2 * run_length] += 1.0  # Pause before the fifth run
+    status = np.repeat(np.resize([STATUS_IMAGINE, STATUS_TRANSITION], runs), run_length)
+    image_id = np.repeat(rng.integers(0, 20, runs), run_length)
+
+    data_dir = Path(tempfile.mkdtemp(prefix="replay_test_"))
+    try:
+        session = data_dir / "paused.csv"
+        pd.DataFrame(
+            {
+                "timestamp": timestamps,
+                "counter": counter.astype(np.float64),
+                "noise": rng.standard_normal(len(counter)),
+                "status": status,
+                "image_id": image_id,
+            }
+        ).to_csv(session, index=False)
+
+        replay = SessionReplay(session, speed=speed, use_merged=True)
+        recorder = CSVDataRecorder(
+            find_streams=False,
+            eeg_query=StreamQuery("EEG", source_id=replay.source_id),
+            marker_query=StreamQuery("Markers", source_id=MARKER_SOURCE_ID),
+        )
+        recorder.find_streams()
+        recorder.start(
+            "recorded.csv", chunked=True, storage="npy", journal_interval=None, data_dir=data_dir
+        )
+        try:
+            time.sleep(0.5)  # Let both inlets connect before the first sample is pushed
+            replay.run()
+            time.sleep(0.5)
+        finally:
+            recorder.stop()
+            recorder.eeg_inlet.close_stream()
+            recorder.marker_inlet.close_stream()
+
+        recorded = load_session_columns(data_dir / "recorded")
+        recorded_counter = np.asarray(recorded["channels"][:, 0]).astype(int)
+        assert np.array_equal(recorded_counter, counter), "The replay lost or reordered samples"
+        assert np.array_equal(recorded["status"], status), (
+            f"{np.count_nonzero(recorded['status'] != status)} samples have the wrong status"
+        )
+        assert np.array_equal(recorded["image_id"], image_id), (
+            f"{np.count_nonzero(recorded['image_id'] != image_id)} samples have the wrong image_id"
+        )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"Recorded replay of a paused merged session keeps the labels of all {len(counter)} samples")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-stream a recorded session over LSL, as EEG and marker outlets."
+    )
+    parser.add_argument("session", help="Session name, e.g. 03-14_10-00-00.csv, or a path.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 1 for real time.")
+    parser.add_argument(
+        "--merged",
+        action="store_true",
+        help="Replay the merged CSV, rebuilding the markers from its labels.",
+    )
+    parser.add_argument("--srate", type=float, help="Recorded sample rate, estimated by default.")
+    args = parser.parse_args()
+
+    try:
+        replay = SessionReplay(args.session, args.speed, args.merged, args.srate)
+    except ValueError as e:
+        parser.error(str(e))
+    print(
+        f"Replaying {args.session} ({len(replay.channel_names)} channels at "
+        f"{replay.srate:g} Hz) at {args.speed:g}x, ^C to stop"
+    )
+    try:
+        replay.run()
+    except KeyboardInterrupt:
+        pass
+    print(f"Replayed {replay.samples_pushed} samples and {replay.markers_pushed} markers")
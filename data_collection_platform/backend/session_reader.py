@@ -0,0 +1,84 @@
+import json
+
+import numpy as np
+
+from pathlib import Path
+
+from backend.storage import DATA_DIR
+
+
+class SessionReader:
+    """Read-only, memory-mapped access to a session recorded with NpyStorage.
+
+    Every column is an np.memmap over the .npy file on disk, so opening a
+    session and slicing trials out of it neither copies nor parses anything.
+    Pages are loaded on first access and shared through the page cache by
+    every process reading the same session.
+
+    Example:
+        session = SessionReader("03-14_10-00-00.csv")
+        trial = session.time_slice(t0, t0 + 2.0)
+        trial["channels"]  # (samples x channels) view into channels.npy
+    """
+
+    def __init__(self, session):
+        """Open a session.
+
+        Args:
+            session (str or Path): Session directory, or the name the session was recorded
+                under (e.g. "03-14_10-00-00.csv"), which is looked up in collected_data.
+
+        Raises:
+            FileNotFoundError: If the session has no .npy directory.
+        """
+        directory = Path(session)
+        if not (directory / "session.json").exists():
+            directory = DATA_DIR / Path(session).stem
+        if not (directory / "session.json").exists():
+            raise FileNotFoundError(
+                f"No .npy session found for {session}. "
+                "CSV sessions can be converted with python -m backend.storage."
+            )
+
+        self.directory = directory
+        with open(directory / "session.json") as f:
+            self.metadata = json.load(f)
+
+        self.timestamps = self._load("timestamps.npy")
+        self.channels = self._load("channels.npy")
+        self.status = self._load("status.npy")
+        self.image_id = self._load("image_id.npy")
+        self.marker_timestamps = self._load("marker_timestamps.npy")
+        self.markers = self._load("markers.npy")
+        self.marker_onsets = self._load_optional("marker_onsets.npy", (0,))
+        self.pauses = self._load_optional("pauses.npy", (0, 2))
+        self.clock_offsets = self._load_optional("clock_offsets.npy", (0, 3))
+
+    def _load(self, name) -> np.memmap:
+        return np.load(self.directory / name, mmap_mode="r")
+
+    def _load_optional(self, name, empty_shape) -> np.ndarray:
+        """Load a file that sessions recorded by older versions do not have."""
+        path = self.directory / name
+        return np.load(path) if path.exists() else np.empty(empty_shape)
+
+    @property
+    def channel_names(self):
+        return self.metadata["channels"]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def slice(self, start, stop) -> dict:
+        """Return views of every per-sample column for samples [start, stop)."""
+        return {
+            "timestamps": self.timestamps[start:stop],
+            "channels": self.channels[start:stop],
+            "status": self.status[start:stop],
+            "image_id": self.image_id[start:stop],
+        }
+
+    def time_slice(self, t_start, t_stop) -> dict:
+        """Return views of every per-sample column for timestamps in [t_start, t_stop)."""
+        start, stop = np.searchsorted(self.timestamps, [t_start, t_stop])
+        return self.slice(start, stop)
@@ -0,0 +1,122 @@
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import logging
+
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PLATFORM_DIR = Path(__file__).resolve().parents[1]
+"""data_collection_platform directory, the working directory modules are imported from
+"""
+
+PROFILED_MODULES = [
+    "main",
+    "master_front_end",
+    "pygame",
+    "backend.csv_data_recorder",
+    "backend.marker_outlet",
+    "pandas",
+    "pylsl",
+]
+"""Modules whose import time is reported by default
+"""
+
+
+class StartupProfile:
+    """Wall-clock timeline of startup phases, which may be marked from several threads.
+
+    Example:
+        profile = StartupProfile()
+        ...
+        profile.mark("window shown")
+        logger.info(profile.report())
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks = []
+        self.lock = threading.Lock()
+
+    def mark(self, phase):
+        """Record that a phase finished now."""
+        with self.lock:
+            self.marks.append(
+                (phase, time.perf_counter() - self.start, threading.current_thread().name)
+            )
+
+    def elapsed(self, phase):
+        """Return the seconds from the start of the profile to a phase, or None if it was not marked."""
+        with self.lock:
+            return next((t for name, t, _ in self.marks if name == phase), None)
+
+    def report(self) -> str:
+        """Return one line per phase, with its time since the start and the thread that marked it."""
+        with self.lock:
+            marks = sorted(self.marks, key=lambda mark: mark[1])
+        lines = ["Startup profile:"]
+        previous = 0.0
+        for phase, t, thread in marks:
+            lines.append(f"  {t * 1000:8.1f} ms  (+{(t - previous) * 1000:7.1f})  {phase}  [{thread}]")
+            previous = t
+        return "\n".join(lines)
+
+
+def import_time(module, python=sys.executable):
+    """Measure the import time of a module in a fresh interpreter with python -X importtime.
+
+    Args:
+        module (str): Module name, importable from PLATFORM_DIR.
+        python (str, optional): Interpreter to run. Defaults to the current one.
+
+    Returns:
+        float: Cumulative import time in seconds, or None if the import failed.
+    """
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PLATFORM_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].rstrip() == f" {module}":
+            return int(fields[1]) / 1e6
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the import time of the modules the data collection platform starts with."
+    )
+    parser.add_argument("modules", nargs="*", default=PROFILED_MODULES)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        help="Exit with status 1 if importing main takes longer than this many milliseconds "
+        "or main was not measured.",
+    )
+    args = parser.parse_args()
+
+    times = {}
+    for module in args.modules:
+        times[module] = import_time(module)
+        if times[module] is None:
+            print(f"{module:>28}: import failed")
+        else:
+            print(f"{module:>28}: {times[module] * 1000:8.1f} ms")
+
+    main_time = times.get("main")
+    if args.budget is not None and main_time is None:
+        print("main was not measured, so the budget cannot be checked")
+        sys.exit(1)
+    sys.exit(1 if args.budget is not None and main_time * 1000 > args.budget else 0)
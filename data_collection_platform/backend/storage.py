@@ -0,0 +1,475 @@
+import argparse
+import json
+import os
+import struct
+import logging
+
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+from constants import *
+from backend.merging import StreamingMerger
+from backend import compression
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path("collected_data")
+"""Directory all recorded sessions are written to
+"""
+
+NPY_HEADER_SIZE = 128
+"""Fixed size of the .npy headers written by NpyAppender, so the shape can be rewritten in place
+"""
+
+CONVERT_BLOCK_SIZE = 16384
+"""Number of CSV rows converted per block by convert_csv_session
+"""
+
+
+class NpyAppender:
+    """Appends rows to a .npy file without holding the array in memory.
+
+    The header is written with a fixed size and rewritten with the new row
+    count after every append, so the file is a valid .npy array (and can be
+    opened with np.load(..., mmap_mode="r")) after each block.
+    """
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.path = Path(path)
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        self.file = open(self.path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.rows,) + self.row_shape,
+            }
+        )
+        header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+        self.file.seek(0)
+        self.file.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)))
+        self.file.write(header.encode("latin1"))
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, rows: np.ndarray):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        self.file.write(rows.tobytes())
+        self.rows += len(rows)
+        self._write_header()
+
+    def close(self):
+        self.file.close()
+
+
+class CSVStorage:
+    """Stores a session as eeg_, markers_ and merged CSV files in collected_data.
+    Existing files of a session with the same name are replaced.
+    """
+
+    def __init__(
+        self, filename, channel_names, num_imgs=20, data_dir=DATA_DIR, clock_offsets=None
+    ):
+        data_dir = Path(data_dir)
+        self.filepath_eeg = data_dir / f"eeg_{filename}"
+        self.filepath_marker = data_dir / f"markers_{filename}"
+        self.filepath_merged = data_dir / filename
+        self.filepath_pauses = data_dir / f"pauses_{filename}"
+        self.filepath_clock_offsets = data_dir / f"clock_offsets_{filename}"
+        self.channel_names = list(channel_names)
+        self.merger = StreamingMerger(self.channel_names, num_imgs, clock_offsets)
+
+        data_dir.mkdir(parents=True, exist_ok=True)
+        for filepath in [
+            self.filepath_eeg,
+            self.filepath_marker,
+            self.filepath_merged,
+            self.filepath_pauses,
+            self.filepath_clock_offsets,
+        ]:
+            filepath.unlink(missing_ok=True)
+
+    def append(self, eeg_block: np.ndarray, marker_block: np.ndarray):
+        """Append a block of EEG samples and a block of markers to the session.
+
+        Args:
+            eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+            marker_block (np.ndarray): (markers x 5) array, timestamp first.
+        """
+        eeg_df = pd.DataFrame(
+            eeg_block,
+            columns=["timestamp"] + self.channel_names,
+            copy=False,
+        )
+
+        marker_df = pd.DataFrame(
+            marker_block[:, 1:].astype("int"),
+            columns=[
+                "has_new_image",
+                "new_image",
+                "has_new_status",
+                "new_status",
+            ],
+        )
+        marker_df.insert(0, "timestamp", marker_block[:, 0])
+
+        merged = self.merger.merge_block(eeg_block, marker_block)
+
+        for df, filepath in [
+            (eeg_df, self.filepath_eeg),
+            (marker_df, self.filepath_marker),
+            (merged, self.filepath_merged),
+        ]:
+            df.to_csv(
+                filepath,
+                mode="a",
+                index=False,
+                header=(not os.path.exists(filepath)),
+            )
+
+    def write_pauses(self, pauses):
+        """Write the (paused_at, resumed_at) LSL timestamps of every pause in the session."""
+        pd.DataFrame(pauses, columns=["paused_at", "resumed_at"]).to_csv(
+            self.filepath_pauses, index=False
+        )
+
+    def write_clock_offsets(self, clock_offsets):
+        """Write the (local_time, eeg_offset, marker_offset) time_correction() captures of the session."""
+        pd.DataFrame(
+            clock_offsets, columns=["local_time", "eeg_offset", "marker_offset"]
+        ).to_csv(self.filepath_clock_offsets, index=False)
+
+    def close(self):
+        pass
+
+
+class NpyStorage:
+    """Stores a session as a directory of binary .npy columns in collected_data.
+
+    Layout of collected_data/<name>/:
+        timestamps.npy          float64 (samples,)
+        channels.npy            float32 (samples x channels)
+        status.npy              int32 (samples,)
+        image_id.npy            int32 (samples,)
+        marker_timestamps.npy   float64 (markers,)
+        markers.npy             int32 (markers x 4), same columns as markers_*.csv
+        marker_onsets.npy       float64 (markers,), fractional sample index of each marker,
+                                except markers after the last sample
+        pauses.npy              float64 (pauses x 2), paused_at and resumed_at LSL timestamps
+        clock_offsets.npy       float64 (captures x 3), local_time, eeg_offset and marker_offset
+        session.json            channel names and row counts
+
+    If the session was recorded without clocksync, timestamps.npy and
+    marker_timestamps.npy hold the raw stream timestamps.
+    """
+
+    def __init__(
+        self, filename, channel_names, num_imgs=20, data_dir=DATA_DIR, clock_offsets=None
+    ):
+        self.directory = Path(data_dir) / Path(filename).stem
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.channel_names = list(channel_names)
+        self.merger = StreamingMerger(self.channel_names, num_imgs, clock_offsets)
+        self.num_imgs = num_imgs
+
+        self.timestamps = NpyAppender(self.directory / "timestamps.npy", np.float64)
+        self.channels = NpyAppender(
+            self.directory / "channels.npy", np.float32, (len(self.channel_names),)
+        )
+        self.status = NpyAppender(self.directory / "status.npy", np.int32)
+        self.image_id = NpyAppender(self.directory / "image_id.npy", np.int32)
+        self.marker_timestamps = NpyAppender(
+            self.directory / "marker_timestamps.npy", np.float64
+        )
+        self.markers = NpyAppender(
+            self.directory / "markers.npy", np.int32, (MARKER_CHANNELS,)
+        )
+        self.marker_onsets = NpyAppender(self.directory / "marker_onsets.npy", np.float64)
+        self.num_pauses = 0
+        self._write_metadata()
+
+    def append(self, eeg_block: np.ndarray, marker_block: np.ndarray):
+        """Append a block of EEG samples and a block of markers to the session.
+
+        Args:
+            eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+            marker_block (np.ndarray): (markers x 5) array, timestamp first.
+        """
+        status, image_id = self.merger.label_block(eeg_block, marker_block)
+
+        self.timestamps.append(eeg_block[:, 0])
+        self.channels.append(eeg_block[:, 1:])
+        self.status.append(status)
+        self.image_id.append(image_id)
+        self.marker_timestamps.append(marker_block[:, 0])
+        self.markers.append(marker_block[:, 1:])
+        self.marker_onsets.append(self.merger.marker_onsets)
+
+    def _write_metadata(self):
+        metadata = {
+            "channels": self.channel_names,
+            "marker_columns": [
+                "has_new_image",
+                "new_image",
+                "has_new_status",
+                "new_status",
+            ],
+            "num_imgs": self.num_imgs,
+            "num_samples": self.timestamps.rows,
+            "num_markers": self.markers.rows,
+            "num_pauses": self.num_pauses,
+        }
+        with open(self.directory / "session.json", "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    def write_pauses(self, pauses):
+        """Write the (paused_at, resumed_at) LSL timestamps of every pause in the session."""
+        np.save(
+            self.directory / "pauses.npy", np.array(pauses, dtype=np.float64).reshape(-1, 2)
+        )
+        self.num_pauses = len(pauses)
+
+    def write_clock_offsets(self, clock_offsets):
+        """Write the (local_time, eeg_offset, marker_offset) time_correction() captures of the session."""
+        np.save(
+            self.directory / "clock_offsets.npy",
+            np.array(clock_offsets, dtype=np.float64).reshape(-1, 3),
+        )
+
+    def close(self):
+        for appender in [
+            self.timestamps,
+            self.channels,
+            self.status,
+            self.image_id,
+            self.marker_timestamps,
+            self.markers,
+            self.marker_onsets,
+        ]:
+            appender.close()
+        self._write_metadata()
+
+
+class CompressedStorage:
+    """Stores a session as one losslessly compressed file, collected_data/<name>.eegz.
+
+    Every flushed block is encoded with backend.compression.encode_block and
+    appended as one record, so the file can be decoded block by block with
+    backend.compression.iter_blocks while it is still being written.
+    """
+
+    def __init__(
+        self, filename, channel_names, num_imgs=20, data_dir=DATA_DIR, clock_offsets=None
+    ):
+        self.path = Path(data_dir) / f"{Path(filename).stem}.eegz"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.merger = StreamingMerger(channel_names, num_imgs, clock_offsets)
+
+        self.file = open(self.path, "wb")
+        compression.write_file_header(
+            self.file, {"channels": list(channel_names), "num_imgs": num_imgs}
+        )
+
+    def append(self, eeg_block: np.ndarray, marker_block: np.ndarray):
+        """Append a block of EEG samples and a block of markers to the session.
+
+        Args:
+            eeg_block (np.ndarray): (samples x 1 + channels) array, timestamp first.
+            marker_block (np.ndarray): (markers x 5) array, timestamp first.
+        """
+        status, image_id = self.merger.label_block(eeg_block, marker_block)
+        payload = compression.encode_block(eeg_block, marker_block, status, image_id)
+        compression.write_record(self.file, compression.RECORD_BLOCK, payload)
+        self.file.flush()
+
+    def write_pauses(self, pauses):
+        """Write the (paused_at, resumed_at) LSL timestamps of every pause in the session."""
+        compression.write_record(
+            self.file,
+            compression.RECORD_PAUSES,
+            np.array(pauses, dtype=np.float64).reshape(-1, 2).tobytes(),
+        )
+
+    def write_clock_offsets(self, clock_offsets):
+        """Write the (local_time, eeg_offset, marker_offset) time_correction() captures of the session."""
+        compression.write_record(
+            self.file,
+            compression.RECORD_CLOCK_OFFSETS,
+            np.array(clock_offsets, dtype=np.float64).reshape(-1, 3).tobytes(),
+        )
+
+    def close(self):
+        self.file.close()
+
+
+STORAGE_BACKENDS = {
+    "csv": CSVStorage,
+    "npy": NpyStorage,
+    "eegz": CompressedStorage,
+}
+"""Storage backends selectable with CSVDataRecorder.start(storage=...)
+"""
+
+
+def convert_csv_session(filename, storage="npy", num_imgs=20, data_dir=DATA_DIR, clocksync=True):
+    """Convert a session recorded as eeg_/markers_ CSV files to another storage backend.
+
+    The EEG file is read in blocks, so the session never has to fit in memory.
+    The pauses_ and clock_offsets_ files of the session are converted too, if
+    they exist.
+
+    Args:
+        filename (str): Name the session was recorded under, e.g. "03-14_10-00-00.csv".
+        storage (str, optional): Key of the target backend in STORAGE_BACKENDS. Defaults to "npy".
+        num_imgs (int, optional): Number of images used in the session. Defaults to 20.
+        data_dir (str or Path, optional): Directory of the session, the converted session is
+            written there too. Defaults to DATA_DIR.
+        clocksync (bool, optional): Whether the session was recorded with clocksync, i.e. its
+            timestamps are already on the local clock. If False, the merge applies the
+            session's clock offsets. Defaults to True.
+    """
+    data_dir = Path(data_dir)
+    marker_df = pd.read_csv(data_dir / f"markers_{filename}", float_precision="round_trip")
+    marker_values = marker_df[
+        ["timestamp", "has_new_image", "new_image", "has_new_status", "new_status"]
+    ].to_numpy(dtype=np.float64)
+
+    pauses = []
+    if (data_dir / f"pauses_{filename}").exists():
+        pauses_df = pd.read_csv(data_dir / f"pauses_{filename}", float_precision="round_trip")
+        pauses = list(pauses_df[["paused_at", "resumed_at"]].itertuples(index=False, name=None))
+
+    clock_offsets = []
+    if (data_dir / f"clock_offsets_{filename}").exists():
+        offsets_df = pd.read_csv(
+            data_dir / f"clock_offsets_{filename}", float_precision="round_trip"
+        )
+        clock_offsets = list(
+            offsets_df[["local_time", "eeg_offset", "marker_offset"]].itertuples(
+                index=False, name=None
+            )
+        )
+
+    filepath_eeg = data_dir / f"eeg_{filename}"
+    channel_names = [c for c in pd.read_csv(filepath_eeg, nrows=0).columns if c != "timestamp"]
+
+    target = STORAGE_BACKENDS[storage](
+        filename,
+        channel_names,
+        num_imgs=num_imgs,
+        data_dir=data_dir,
+        clock_offsets=None if clocksync else clock_offsets,
+    )
+    marker_start = 0
+    for eeg_df in pd.read_csv(
+        filepath_eeg, chunksize=CONVERT_BLOCK_SIZE, float_precision="round_trip"
+    ):
+        eeg_block = eeg_df[["timestamp"] + channel_names].to_numpy(dtype=np.float64)
+        if not len(eeg_block):
+            continue
+        marker_end = np.searchsorted(marker_values[:, 0], eeg_block[-1, 0])
+        target.append(eeg_block, marker_values[marker_start:marker_end])
+        marker_start = marker_end
+    if marker_start < len(marker_values):
+        # Markers at or after the last sample, such as the stop marker
+        target.append(np.empty((0, 1 + len(channel_names))), marker_values[marker_start:])
+    target.write_pauses(pauses)
+    target.write_clock_offsets(clock_offsets)
+    target.close()
+
+    logger.info(f"Converted {filename} to {storage}")
+
+
+def test_convert_csv_session(num_samples=1000, srate=250.0):
+    """Convert CSV sessions, one of them without EEG rows, to npy and check every file carries over."""
+    import shutil
+    import tempfile
+
+    from backend.session_reader import SessionReader
+
+    channel_names = ["E0", "E1"]
+    timestamps = 100.0 + np.arange(num_samples) / srate
+    end = timestamps[-1] + 1 / srate
+    markers = pd.DataFrame(
+        [
+            [100.0, 1, 3, 1, STATUS_IMAGINE],
+            [101.0, 0, IMAGE_NONE, 1, STATUS_TRANSITION],
+            [end, 0, IMAGE_NONE, 1, STATUS_DONE],  # Stop marker after the last sample
+        ],
+        columns=["timestamp", "has_new_image", "new_image", "has_new_status", "new_status"],
+    )
+    pauses = pd.DataFrame([[101.5, 102.0]], columns=["paused_at", "resumed_at"])
+    offsets = pd.DataFrame(
+        [[100.0, 0.01, 0.02], [end, 0.01, 0.02]],
+        columns=["local_time", "eeg_offset", "marker_offset"],
+    )
+
+    data_dir = Path(tempfile.mkdtemp(prefix="convert_test_"))
+    try:
+        for filename, eeg_timestamps in [
+            ("full.csv", timestamps),
+            ("empty.csv", timestamps[:0]),
+        ]:
+            eeg_df = pd.DataFrame({"timestamp": eeg_timestamps})
+            for i, name in enumerate(channel_names):
+                eeg_df[name] = np.arange(len(eeg_timestamps)) + i
+            eeg_df.to_csv(data_dir / f"eeg_{filename}", index=False)
+            markers.to_csv(data_dir / f"markers_{filename}", index=False)
+            pauses.to_csv(data_dir / f"pauses_{filename}", index=False)
+            offsets.to_csv(data_dir / f"clock_offsets_{filename}", index=False)
+
+            convert_csv_session(filename, "npy", data_dir=data_dir)
+
+            reader = SessionReader(data_dir / Path(filename).stem)
+            assert len(reader) == len(eeg_timestamps), f"{filename}: samples differ"
+            assert np.array_equal(reader.timestamps, eeg_timestamps), f"{filename}: timestamps differ"
+            assert np.array_equal(reader.marker_timestamps, markers["timestamp"]), (
+                f"{filename}: markers were lost"
+            )
+            assert np.array_equal(reader.pauses, pauses.to_numpy()), f"{filename}: pauses differ"
+            assert np.array_equal(reader.clock_offsets, offsets.to_numpy()), (
+                f"{filename}: clock offsets differ"
+            )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print("Converted a session and a session without EEG rows, with markers, pauses and clock offsets")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert sessions in collected_data from CSV to a binary storage backend."
+    )
+    parser.add_argument(
+        "filenames",
+        nargs="*",
+        help="Session names, e.g. 03-14_10-00-00.csv. Defaults to every eeg_*.csv in collected_data.",
+    )
+    parser.add_argument(
+        "--storage", default="npy", choices=[k for k in STORAGE_BACKENDS if k != "csv"]
+    )
+    parser.add_argument("--data-dir", default=DATA_DIR, type=Path)
+    parser.add_argument(
+        "--no-clocksync",
+        action="store_true",
+        help="The sessions were recorded with clocksync=False, merge them with their clock offsets.",
+    )
+    args = parser.parse_args()
+
+    filenames = args.filenames or [
+        path.name[len("eeg_") :] for path in sorted(args.data_dir.glob("eeg_*.csv"))
+    ]
+    for filename in filenames:
+        print(f"Converting {filename}...")
+        convert_csv_session(
+            filename,
+            storage=args.storage,
+            data_dir=args.data_dir,
+            clocksync=not args.no_clocksync,
+        )
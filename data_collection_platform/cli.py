@@ -1,8 +1,9 @@
 import pathlib
 import logging
 
-from marker_outlet import MarkerOutlet, decode_status
-from csv_data_recorder import CSVDataRecorder
+from backend.marker_outlet import MarkerOutlet, decode_status
+from backend.csv_data_recorder import CSVDataRecorder
+from backend.discovery import StreamNotFoundError
 from constants import *
 
 
@@ -131,7 +132,11 @@ def cli():
 
         elif user_input == "5":
             print("Looking for streams...")
-            data_recorder.find_streams()
+            try:
+                data_recorder.find_streams()
+            except StreamNotFoundError as e:
+                print(e)
+                continue
             print("Found streams. Ready to start recording.")
 
 
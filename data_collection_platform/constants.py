@@ -48,3 +48,20 @@ NO_UPDATE = 0
 SHOULD_UPDATE = 1
 """Code if state (image or experiment) has been updated
 """
+
+IS_EVENT = 2
+"""Code in has_new_status if the marker carries an event code in new_status instead of a new status.
+Event markers do not change the status or image labels
+"""
+
+EVENT_CHECKPOINT = 1
+"""Event code for a checkpoint, i.e. the end of a cycle
+"""
+
+EVENT_STOP = 2
+"""Event code for the end of the session, sent right before the recording stops
+"""
+
+MARKER_CHANNELS = 4
+"""Number of values in a marker sample (has_new_image, new_image, has_new_status, new_status)
+"""
@@ -1,42 +1,123 @@
-import datetime
 import logging
 import pathlib
-from backend.csv_data_recorder import CSVDataRecorder
-from backend.marker_outlet import MarkerOutlet
-from master_front_end import runPyGame
+import sys
+import threading
+
+from backend.startup_profile import StartupProfile
 from constants import *
 
-# Initialize data recorder and marker outlet
-collector = CSVDataRecorder(find_streams=False)
-marker_outlet = MarkerOutlet()
+logger = logging.getLogger(__name__)
 
-# Logging configuration
-log_path = pathlib.Path(f"logs/data_collection_platform.log")
-log_path.parent.mkdir(parents=True, exist_ok=True)
+# The recorder, the marker outlet and the UI pull in pandas, pylsl and pygame,
+# so they are imported and created by start_backend() and main() instead of
+# at import time. Stream discovery then runs while the window opens.
+profile = StartupProfile()
+collector = None
+marker_outlet = None
+backend_ready = threading.Event()
+backend_error = None
+window_shown = threading.Event()
 
-logging.basicConfig(
-    filename=log_path,
-    filemode="w",
-    level=logging.INFO,
-    format="%(asctime)s %(name)s %(levelname)s %(message)s",
-)
+STARTUP_REPORT_TIMEOUT = 30.0
+"""Seconds the startup profile waits for the window to show before it is logged anyway
+"""
 
 
-# Callback functions for different stages
-def on_start():
-    collector.find_streams()
+def setup_logging():
+    log_path = pathlib.Path(f"logs/data_collection_platform.log")
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    logging.basicConfig(
+        filename=log_path,
+        filemode="w",
+        level=logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s %(message)s",
+    )
+
+
+def start_backend(filename):
+    """Create the marker outlet, find the streams and start recording to filename.
+
+    Runs in a background thread while the UI starts. Marker and recorder
+    callbacks wait for it with wait_for_backend().
+    """
+    global collector, marker_outlet, backend_error
+
+    try:
+        from backend.csv_data_recorder import CSVDataRecorder
+        from backend.marker_outlet import MarkerOutlet
+        from backend.discovery import StreamNotFoundError
+
+        profile.mark("backend imported")
+        # Stage markers are stamped with the flip that shows the stage, see on_flip()
+        marker_outlet = MarkerOutlet(sync_to_flip=True)
+        collector = CSVDataRecorder(find_streams=False)
+        profile.mark("marker outlet created")
+
+        try:
+            collector.find_streams()
+        except StreamNotFoundError as e:
+            backend_error = e
+            print(f"{e}\nLSL streams not ready. Please ensure EEG and Marker streams are running.")
+            _close_window()
+            return
+        profile.mark("streams found")
+
+        print(f"Starting data recording... Saving to: {filename}")
+        collector.start(filename=filename, chunked=True)
+        profile.mark("recording started")
+    finally:
+        backend_ready.set()
+
+    window_shown.wait(STARTUP_REPORT_TIMEOUT)
+    logger.info(profile.report())
+    print(
+        f"Startup: window shown after {_since_filename('window shown')}, "
+        f"recording started after {_since_filename('recording started')}"
+    )
+
+
+def _since_filename(phase):
+    elapsed, entered = profile.elapsed(phase), profile.elapsed("filename entered")
+    if elapsed is None or entered is None:
+        return "-"
+    return f"{elapsed - entered:.2f} s"
 
-    if collector.ready:
-        name = datetime.datetime.now().strftime("%m-%d_%H-%M-%S")
-        collector.start(filename=f"{name}.csv")
-    else:
-        print("Data not ready - quit and try again.")
 
+def _close_window():
+    """Ask the UI, if it is running, to quit."""
+    pygame = sys.modules.get("pygame")
+    if pygame is not None and pygame.display.get_init():
+        pygame.event.post(pygame.event.Event(pygame.QUIT))
 
+
+def wait_for_backend():
+    """Block until start_backend() has finished, exiting if the streams were not found."""
+    backend_ready.wait()
+    if backend_error is not None:
+        sys.exit(1)
+
+
+def on_first_frame():
+    profile.mark("window shown")
+    window_shown.set()
+
+
+def on_flip():
+    if marker_outlet is not None:
+        marker_outlet.on_flip()
+
+
+# Callback functions for different stages
 def on_stop():
     """Handles stopping the session from the checkpoint."""
     print("Stopping session... Saving data and closing streams.")
 
+    # Send LSL stop marker, and wait for it to be pushed so it is recorded
+    wait_for_backend()
+    marker_outlet.send_stop_marker()
+    marker_outlet.flush()
+
     # Save all recorded EEG data
     #collector.save_and_close()
     collector.stop()
@@ -50,46 +131,53 @@ def on_stop():
     except Exception as e:
         print(f"Warning: Unable to stop EEG stream properly: {e}")
 
-    # Send LSL stop marker
-    #marker_outlet.send_stop_marker()
-
     print("Session successfully stopped.")
 
 
 def on_home_screen():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_TRANSITION)
 
 
 def on_baseline():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_BASELINE)
 
 
 def on_imagine(image_id: int):
+    wait_for_backend()
     marker_outlet.send(new_image=image_id, new_status=STATUS_IMAGINE)
 
 
 def on_white_screen():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_TRANSITION)
 
 
 def on_rest():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_TRANSITION)
 
 
 def on_look_at_image():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_LOOK)
 
 
 def on_close_eyes_imagine():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_IMAGINE_EYES_CLOSED)
 
 
 def on_cycle_complete():
+    wait_for_backend()
     marker_outlet.send_transition(STATUS_TRANSITION)
+    marker_outlet.send_checkpoint_marker()
     collector.pause()
 
 
 def on_cycle_start():
+    wait_for_backend()
     collector.unpause()
 
 
@@ -115,19 +203,21 @@ def create_priming_sequence():
 
 # Main data collection function
 def main():
+    setup_logging()
+    profile.mark("imports")
+
     # Prompt user to enter CSV filename
     filename = input("Enter the name of the CSV file (without extension): ") + ".csv"
+    profile.mark("filename entered")
 
-    # Start recording EEG data
-    collector.find_streams()
-    if collector.ready:
-        print(f"Starting data recording... Saving to: {filename}")
-        collector.start(filename=filename)
-    else:
-        print(
-            "LSL streams not ready. Please ensure EEG and Marker streams are running."
-        )
-        return
+    # Find the streams and start recording EEG data while the UI starts
+    threading.Thread(
+        target=start_backend, args=[filename], name="startup", daemon=True
+    ).start()
+
+    from master_front_end import runPyGame
+
+    profile.mark("UI imported")
 
     sequence = create_priming_sequence()
     random_sequence = create_train_sequence()
@@ -155,6 +245,8 @@ def main():
         on_cycle_complete=on_cycle_complete,  # The checkpoint is inside this function
         on_cycle_start=on_cycle_start,
         on_stop=on_stop,  # Now properly saves and stops EEG
+        on_first_frame=on_first_frame,
+        on_flip=on_flip,
     )
 
 
@@ -2,13 +2,134 @@ import sys
 import pygame
 from pygame.locals import *
 import time
-import threading
+import heapq
 import random
 import os  # To extract the image name from the file path
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 screen_width = 1200  # Set your desired width
 screen_height = 800  # Set your desired height
-screen = pygame.display.set_mode((screen_width, screen_height))  # Windowed mode
+# The window is opened by runPyGame, so importing this module does not open one
+
+FRAME_RATE = 60
+"""Frames per second the render loop is paced to, the refresh rate of common displays
+"""
+
+MISSED_FRAME_FACTOR = 1.5
+"""A frame interval longer than this many frame periods counts as a missed frame
+"""
+
+IMAGE_SIZE = (400, 400)
+"""Size images are shown at, shrunk to fit windows that are too small
+"""
+
+IMAGE_MARGIN = 50
+"""Minimum space in pixels between a shrunk image and the window border
+"""
+
+IMAGE_CACHE_SIZE = 64
+"""Number of decoded images ImageCache keeps, the least recently used is evicted first
+"""
+
+FONT_NAME = "Arial"
+"""System font all prompts are rendered with, in bold
+"""
+
+TEXT_CACHE_SIZE = 256
+"""Number of rendered text surfaces TextCache keeps, the least recently used is evicted first
+"""
+
+BACKGROUND_TEXT_COLOR = (51, 51, 51)
+"""Color of text on the light gray screens
+"""
+
+FOREGROUND_TEXT_COLOR = (255, 255, 255)
+"""Color of text on the dark blue screens
+"""
+
+INSTRUCTIONS = [
+    "• You will go through a sequence of prompts.",
+    "• First, a baseline calibration will be recorded.",
+    "• Rest periods will be indicated by a LIGHT BLUE screen.",
+    "• Each prompt lasts for a few seconds.",
+    "• There will be multiple cycles.",
+    "• Press SPACE to begin.",
+]
+"""Lines of the instruction screen
+"""
+
+
+class StageScheduler:
+    """Runs stage changes at absolute deadlines on the time.monotonic() clock.
+
+    The render loop calls run_due() once per frame, so stage changes happen
+    in the same thread that draws them, between two frames. A stage is
+    scheduled relative to the deadline of the transition that entered the
+    current stage, not to when that transition actually ran, so late
+    transitions do not push back the rest of the session.
+
+    Every transition is recorded as [stage, planned, entered, presented]:
+    its deadline, when it ran and when the first frame showing it was
+    flipped (None until then).
+    """
+
+    def __init__(self):
+        self.pending = []  # heap of (deadline, order, stage_method, args)
+        self.order = 0
+        self.deadline = None  # Deadline of the transition being run
+        self.transitions = []
+
+    def schedule(self, delay, stage_method, *args):
+        """Run stage_method(*args) delay seconds after the current stage's planned start."""
+        base = self.deadline if self.deadline is not None else time.monotonic()
+        heapq.heappush(self.pending, (base + delay, self.order, stage_method, args))
+        self.order += 1
+
+    def run_due(self, now):
+        """Run the stage changes whose deadline is at or before now, in deadline order."""
+        while self.pending and self.pending[0][0] <= now:
+            deadline, _, stage_method, args = heapq.heappop(self.pending)
+            self.deadline = deadline
+            try:
+                stage_method(*args)
+            finally:
+                self.deadline = None
+
+    def planned_start(self):
+        """Return the deadline of the transition being run, or now if the stage was entered directly."""
+        return self.deadline if self.deadline is not None else time.monotonic()
+
+    def record(self, stage, planned):
+        self.transitions.append([stage, planned, time.monotonic(), None])
+
+    def presented(self, timestamp):
+        """Record the flip that shows the latest transition, if it was not shown yet."""
+        if self.transitions and self.transitions[-1][3] is None:
+            self.transitions[-1][3] = timestamp
+
+    def report(self) -> str:
+        """Return a one-line summary of how late the transitions ran and were shown."""
+        late = [entered - planned for _, planned, entered, _ in self.transitions]
+        shown = [
+            presented - planned
+            for _, planned, _, presented in self.transitions
+            if presented is not None
+        ]
+        if not late:
+            return "no transitions"
+        report = (
+            f"{len(late)} transitions, entered late by mean {sum(late) / len(late) * 1000:.1f} ms, "
+            f"max {max(late) * 1000:.1f} ms"
+        )
+        if shown:
+            report += (
+                f", shown late by mean {sum(shown) / len(shown) * 1000:.1f} ms, "
+                f"max {max(shown) * 1000:.1f} ms"
+            )
+        return report
 
 
 class Context:
@@ -46,6 +167,12 @@ class Context:
         self.in_random_cycle=False
         self.image_indices = []
         self.random_sequence = random_sequence
+        # Stage changes are timed by the scheduler and run by the render loop
+        self.scheduler = StageScheduler()
+        # Planned start (time.monotonic()) and seconds of the current stage, for its animations
+        self.stage_start = time.monotonic()
+        self.stage_duration = None
+        self.stage_entries = 0  # Bumped on every stage entry, so re-entering a stage is redrawn
 
         # Callbacks for each stage
         self._on_home_screen = on_home_screen
@@ -62,86 +189,77 @@ class Context:
         self._on_next_cycle = on_cycle_start
         self._on_stop = on_stop
 
+    def _set_stage(self, stage, duration=None):
+        """Enter a stage, recording its planned start for the animations drawn during it."""
+        self.current_stage = stage
+        self.stage_entries += 1
+        self.stage_start = self.scheduler.planned_start()
+        self.stage_duration = duration
+        self.scheduler.record(stage, self.stage_start)
+
+    def stage_progress(self, now):
+        """Return the fraction of the current stage's duration that has passed at now, from 0 to 1."""
+        if not self.stage_duration:
+            return 0.0
+        return min(max((now - self.stage_start) / self.stage_duration, 0.0), 1.0)
+
     def on_home_screen(self):
-        self.current_stage = "home_screen"
+        self._set_stage("home_screen")
         # self._on_home_screen()
         # no work to be done for LSL since the state starts in STATUS_TRANSITION
 
     def on_instruction_screen(self):
-        self.current_stage = "instruction_screen"
+        self._set_stage("instruction_screen")
 
     def on_baseline(self,time=10):
         if not self.baseline_done:  # Ensure baseline happens only once
-            self.current_stage = "baseline"
+            self._set_stage("baseline", time)
             self._on_baseline()
             # self._on_baseline()
             self.baseline_done = True
             # Immediately proceed to the next stage
             self.train_index += 1
-            thread = threading.Timer(
-                time,
-                self.on_next_stage,
-            )  # Proceed to the next stage
-            thread.daemon = True
-            thread.start()
+            self.scheduler.schedule(time, self.on_next_stage)  # Proceed to the next stage
 
     def on_imagine(self,time=4):
-        self.current_stage = "imagine"
+        self._set_stage("imagine", time)
         self._on_imagine(self.image_index)
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_white_screen_1(self,time=2):
-        self.current_stage = "white_screen_1"
+        self._set_stage("white_screen_1", time)
         self._on_white_screen_1()
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_rest_1(self, time=5):
-        self.current_stage = "rest_1"
+        self._set_stage("rest_1", time)
         self._on_rest_1()
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_look_at_image(self,time=6):
-        self.current_stage = "look_at_image"
+        self._set_stage("look_at_image", time)
         self._on_look_at_image()
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_rest_2(self,time=5):
-        self.current_stage = "rest_2"
+        self._set_stage("rest_2", time)
         self._on_rest_2()
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_close_eyes_imagine(self,time=4):
-        self.current_stage = "close_eyes_imagine"
+        self._set_stage("close_eyes_imagine", time)
         self._on_close_eyes_imagine()
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_white_screen_2(self,time=2):
-        self.current_stage = "white_screen_2"
+        self._set_stage("white_screen_2", time)
         self._on_white_screen_2()
-        thread = threading.Timer(time, self.on_next_stage)
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)
 
     def on_rest_3(self,time=5):
-        self.current_stage = "rest_3"
+        self._set_stage("rest_3", time)
         self._on_rest_3()
-        thread = threading.Timer(
-            time, self.on_next_stage
-        )  # Conclude the cycle and start the next one
-        thread.daemon = True
-        thread.start()
+        self.scheduler.schedule(time, self.on_next_stage)  # Conclude the cycle and start the next one
 
     def on_next_stage(self):
         # Check if we have more stages left
@@ -172,9 +290,7 @@ class Context:
                 time = random.randint(0,2)*0.05
                 print(f"waiting {time}")
                 if (time != 0):
-                    thread = threading.Timer(time, self.on_look_at_image,args=[1]) 
-                    thread.daemon = True
-                    thread.start()
+                    self.scheduler.schedule(time, self.on_look_at_image, 1)
                 else:
                     self.on_look_at_image(1)
                 
@@ -224,13 +340,13 @@ class Context:
 
             # Now, the main event loop (update function) will handle user input (Y/N)
         elif self.in_random_cycle == False:
-            self.current_stage = "priming_complete"
+            self._set_stage("priming_complete")
             self._on_cycle_complete()
             print("Priming phase complete. Continue to random trials?")
             
             
         else:
-            self.current_stage = "complete"
+            self._set_stage("complete")
             self._on_stop()
 
 
@@ -269,19 +385,194 @@ class Context:
 
 
 
-def fade_screen(screen, duration=500):
+def image_size(window_size):
+    """Return IMAGE_SIZE, shrunk to fit in a window of window_size with IMAGE_MARGIN around it."""
+    width, height = window_size
+    scale = min(
+        1.0,
+        (width - 2 * IMAGE_MARGIN) / IMAGE_SIZE[0],
+        (height - 2 * IMAGE_MARGIN) / IMAGE_SIZE[1],
+    )
+    return (max(1, int(IMAGE_SIZE[0] * scale)), max(1, int(IMAGE_SIZE[1] * scale)))
+
+
+class ImageCache:
+    """Decoded stimulus images in the display pixel format, scaled for the current window.
+
+    Decoding a PNG and scaling it takes milliseconds, so every image is
+    prepared once, before the session, with preload() instead of on every
+    frame. An image is only scaled again when the window size changes. At
+    most max_entries images are kept, the least recently used is evicted.
+    """
+
+    def __init__(self, max_entries=IMAGE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # path -> [decoded, window size, scaled]
+
+    def preload(self, paths, window_size):
+        """Decode, convert and scale images before they are shown. Requires an open window."""
+        for path in list(dict.fromkeys(paths))[: self.max_entries]:
+            self.get(path, window_size)
+
+    def get(self, path, window_size):
+        """Return the image at path scaled for a window of window_size, or None if it cannot be loaded."""
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = [self._load(path), None, None]
+            self.entries[path] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(path)
+
+        decoded, scaled_for, _ = entry
+        if decoded is not None and scaled_for != window_size:
+            entry[1] = window_size
+            entry[2] = pygame.transform.scale(decoded, image_size(window_size))
+        return entry[2]
+
+    def _load(self, path):
+        try:
+            image = pygame.image.load(path)
+        except (pygame.error, FileNotFoundError):
+            return None
+        # Blitting a surface in the display's pixel format skips a per-frame conversion
+        return image.convert_alpha() if image.get_flags() & pygame.SRCALPHA else image.convert()
+
+
+image_cache = ImageCache()
+
+_fonts = {}
+"""pygame fonts by (name, size, bold, italic), looking up a system font is slow
+"""
+
+
+def get_font(font_size, name=FONT_NAME, bold=True, italic=False):
+    """Return a system font, creating it only the first time it is asked for."""
+    key = (name, font_size, bold, italic)
+    if key not in _fonts:
+        _fonts[key] = pygame.font.SysFont(name, font_size, bold, italic)
+    return _fonts[key]
+
+
+class TextCache:
+    """Rendered text surfaces by (text, font size, color), with LRU eviction.
+
+    Prompts are drawn on every frame, so each one is rendered once, ideally
+    before the session with preload(), and blitted from the cache afterwards.
+    """
+
+    def __init__(self, max_entries=TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (text, font size, color) -> surface
+
+    def preload(self, prompts):
+        """Render (text, font size, color) prompts before they are shown."""
+        for text, font_size, color in prompts:
+            self.get(text, font_size, color)
+
+    def get(self, text, font_size, color):
+        """Return text rendered in FONT_NAME, rendering it if it is not cached."""
+        key = (text, font_size, tuple(color))
+        surface = self.entries.get(key)
+        if surface is None:
+            surface = get_font(font_size).render(text, True, color)
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            self.entries[key] = surface
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return surface
+
+
+text_cache = TextCache()
+
+
+def imagine_prompt(image):
+    """Return the prompt asking to imagine the object of an image path."""
+    return f"Imagine: {os.path.splitext(os.path.basename(image))[0]}"
+
+
+def session_prompts(image_list):
+    """Return every (text, font size, color) prompt draw() shows in a session with image_list."""
+    prompts = [(line, 30, BACKGROUND_TEXT_COLOR) for line in INSTRUCTIONS]
+    prompts += [
+        ("NTech Data Collection Interface 2025", 30, BACKGROUND_TEXT_COLOR),
+        ("Press SPACE to Start", 35, BACKGROUND_TEXT_COLOR),
+        ("Image not found", 40, BACKGROUND_TEXT_COLOR),
+        ("Continue?", 50, FOREGROUND_TEXT_COLOR),
+        ("Priming Phase Complete. Continue?", 50, FOREGROUND_TEXT_COLOR),
+        ("[YES]    [NO]", 40, FOREGROUND_TEXT_COLOR),
+        ("No more images. Task Complete.", 40, FOREGROUND_TEXT_COLOR),
+    ]
+    prompts += [(imagine_prompt(image), 40, BACKGROUND_TEXT_COLOR) for image in image_list]
+    return prompts
+
+
+class FrameStats:
+    """Timing of the frames of the render loop, logged once per session.
+
+    Every loop iteration is one frame. The frame interval is the time
+    between two frames, and a frame counts as missed when its interval is
+    longer than MISSED_FRAME_FACTOR frame periods. Render time is only
+    measured for frames that were redrawn and flipped.
+    """
+
+    def __init__(self, frame_rate=FRAME_RATE):
+        self.frame_period = 1 / frame_rate
+        self.frames = 0
+        self.redraws = 0
+        self.missed_frames = 0
+        self.intervals = []
+        self.render_times = []
+        self.last_frame = None
+
+    def frame(self, render_time=None):
+        """Record a frame, with the seconds it took to draw and flip if it was redrawn."""
+        now = time.perf_counter()
+        if self.last_frame is not None:
+            interval = now - self.last_frame
+            self.intervals.append(interval)
+            if interval > MISSED_FRAME_FACTOR * self.frame_period:
+                self.missed_frames += 1
+        self.last_frame = now
+        self.frames += 1
+        if render_time is not None:
+            self.redraws += 1
+            self.render_times.append(render_time)
+
+    def report(self) -> str:
+        """Return a one-line summary of the frame intervals, missed frames and render times."""
+        if not self.intervals:
+            return f"{self.frames} frames"
+        intervals = sorted(self.intervals)
+        p95 = intervals[int(0.95 * (len(intervals) - 1))]
+        report = (
+            f"{self.frames} frames, {self.redraws} redrawn, {self.missed_frames} missed "
+            f"(> {MISSED_FRAME_FACTOR * self.frame_period * 1000:.1f} ms). Frame interval: "
+            f"mean {sum(intervals) / len(intervals) * 1000:.1f} ms, "
+            f"p95 {p95 * 1000:.1f} ms, max {intervals[-1] * 1000:.1f} ms"
+        )
+        if self.render_times:
+            report += (
+                f". Render time: mean {sum(self.render_times) / len(self.render_times) * 1000:.2f} ms, "
+                f"max {max(self.render_times) * 1000:.2f} ms"
+            )
+        return report
+
+
+def draw_fade(screen, progress, color=(240, 240, 240)):
+    """Draw one frame of a fade to color, progress going from 0 (no fade) to 1 (fully faded)."""
     fade = pygame.Surface((screen.get_width(), screen.get_height()))
-    fade.fill((240, 240, 240))  # Light gray fade
-    for alpha in range(0, 255, 10):  # Gradual fade effect
-        fade.set_alpha(alpha)
-        screen.blit(fade, (0, 0))
-        pygame.display.update()
-        pygame.time.delay(duration // 50)
+    fade.fill(color)  # Light gray fade by default
+    fade.set_alpha(int(255 * min(max(progress, 0.0), 1.0)))
+    screen.blit(fade, (0, 0))
 
 
-def show_text(screen, text, font_size=30, color=(51, 51, 51), y_offset=0, align="left"):
-    font = pygame.font.SysFont("Arial", font_size, True, False)
-    surface = font.render(text, True, color)
+def show_text(screen, text, font_size=30, color=BACKGROUND_TEXT_COLOR, y_offset=0, align="left"):
+    surface = text_cache.get(text, font_size, color)
     if align == "center":
         text_rect = surface.get_rect(
             center=(screen.get_width() // 2, screen.get_height() // 2 + y_offset)
@@ -291,47 +582,38 @@ def show_text(screen, text, font_size=30, color=(51, 51, 51), y_offset=0, align=
     screen.blit(surface, text_rect)
 
 
-def progress_bar(screen, duration):
+def progress_bar_rect(screen, progress):
+    """Return the filled part of the progress bar at progress, from 0 to 1."""
     bar_width = screen.get_width() - 100
     bar_height = 30  # Smaller height for minimal distraction
     bar_x = (screen.get_width() - bar_width) // 2
     bar_y = screen.get_height() - bar_height - 50  # Higher placement
+    return pygame.Rect(bar_x, bar_y, int(bar_width * progress), bar_height)
 
-    start_time = time.time()
 
-    running = True
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+def draw_progress_bar(screen, progress):
+    """Draw one frame of the progress bar, advanced by the render loop instead of its own loop."""
+    pygame.draw.rect(screen, (90, 125, 154), progress_bar_rect(screen, progress))
 
-        elapsed_time = time.time() - start_time
-        progress = min(elapsed_time / duration, 1.0)  # Scale progress correctly
 
-        pygame.draw.rect(
-            screen,
-            (90, 125, 154),
-            pygame.Rect(bar_x, bar_y, bar_width * progress, bar_height),
-        )
-        pygame.display.flip()
+def animation_frame(screen, ctx, now):
+    """Return what the animations of the current stage look like at now, None if nothing is animated.
 
-        if elapsed_time >= duration:
-            time.sleep(0.3)  # Shorter pause at the end
-            running = False
+    The render loop redraws a frame when this changes, so an animation is
+    redrawn only when it moves by at least a pixel.
+    """
+    if ctx.current_stage in ["rest_1", "rest_2", "rest_3"]:
+        return progress_bar_rect(screen, ctx.stage_progress(now)).width
+    return None
 
 
-def draw(screen, ctx, current_image=None):
+def draw(screen, ctx, current_image=None, now=None):
+    """Draw and flip the frame of the current stage, with its animations as they are at now."""
+    if now is None:
+        now = time.monotonic()
     if ctx.current_stage == "instruction_screen":
         screen.fill((240, 240, 240))  # Soft gray background
-        instructions = [
-            "• You will go through a sequence of prompts.",
-            "• First, a baseline calibration will be recorded.",
-            "• Rest periods will be indicated by a LIGHT BLUE screen.",
-            "• Each prompt lasts for a few seconds.",
-            "• There will be multiple cycles.",
-            "• Press SPACE to begin.",
-        ]
-        for i, line in enumerate(instructions):
+        for i, line in enumerate(INSTRUCTIONS):
             show_text(screen, line, font_size=30, y_offset=i * 40, align="left")
 
     elif ctx.current_stage == "home_screen":
@@ -353,36 +635,33 @@ def draw(screen, ctx, current_image=None):
     elif ctx.current_stage == "imagine":
         screen.fill((240, 240, 240))
         if current_image:
-            image_name = os.path.splitext(os.path.basename(current_image))[0]
-            show_text(screen, f"Imagine: {image_name}", font_size=40, align="center")
-            #progress_bar(screen, 2)
+            show_text(screen, imagine_prompt(current_image), font_size=40, align="center")
+            #draw_progress_bar(screen, ctx.stage_progress(now))
 
     elif ctx.current_stage == "white_screen_1":
         screen.fill((240, 240, 240))
 
     elif ctx.current_stage in ["rest_1", "rest_2", "rest_3"]:
         screen.fill((221, 238, 255))  # Soft blue for rest
-        progress_bar(screen, 5)
+        draw_progress_bar(screen, ctx.stage_progress(now))
 
     elif ctx.current_stage == "look_at_image":
         screen.fill((240, 240, 240))
         if current_image:
-            try:
-                image = pygame.image.load(current_image)
-                image = pygame.transform.scale(image, (400, 400))
+            image = image_cache.get(current_image, screen.get_size())
+            if image is not None:
                 image_rect = image.get_rect(
                     center=(screen.get_width() // 2, screen.get_height() // 2)
                 )
                 screen.blit(image, image_rect)
-            except pygame.error:
+            else:
                 show_text(screen, "Image not found", font_size=40, align="center")
 
     elif ctx.current_stage == "close_eyes_imagine":
         screen.fill((240, 240, 240))
         if current_image:
-            image_name = os.path.splitext(os.path.basename(current_image))[0]
-            show_text(screen, f"Imagine: {image_name}", font_size=40, align="center")
-            #progress_bar(screen, 2)
+            show_text(screen, imagine_prompt(current_image), font_size=40, align="center")
+            #draw_progress_bar(screen, ctx.stage_progress(now))
 
     elif ctx.current_stage == "white_screen_2":
         screen.fill((240, 240, 240))
@@ -393,7 +672,7 @@ def draw(screen, ctx, current_image=None):
             screen,
             "Continue?",
             font_size=50,
-            color=(255, 255, 255),
+            color=FOREGROUND_TEXT_COLOR,
             align="center",
             y_offset=-30,
         )
@@ -401,7 +680,7 @@ def draw(screen, ctx, current_image=None):
             screen,
             "[YES]    [NO]",
             font_size=40,
-            color=(255, 255, 255),
+            color=FOREGROUND_TEXT_COLOR,
             align="center",
             y_offset=30,
         )
@@ -411,7 +690,7 @@ def draw(screen, ctx, current_image=None):
             screen,
             "Priming Phase Complete. Continue?",
             font_size=50,
-            color=(255, 255, 255),
+            color=FOREGROUND_TEXT_COLOR,
             align="center",
             y_offset=-30,
         )
@@ -419,7 +698,7 @@ def draw(screen, ctx, current_image=None):
             screen,
             "[YES]    [NO]",
             font_size=40,
-            color=(255, 255, 255),
+            color=FOREGROUND_TEXT_COLOR,
             align="center",
             y_offset=30,
         )
@@ -429,7 +708,7 @@ def draw(screen, ctx, current_image=None):
             screen,
             "No more images. Task Complete.",
             font_size=40,
-            color=(255, 255, 255),
+            color=FOREGROUND_TEXT_COLOR,
             align="center",
         )
 
@@ -437,8 +716,12 @@ def draw(screen, ctx, current_image=None):
 
 
 def update(ctx):
+    """Handle pending events, returning True if the window needs to be redrawn."""
+    redraw = False
     for event in pygame.event.get():
-        if event.type == pygame.QUIT:
+        if event.type in (pygame.VIDEORESIZE, pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+            redraw = True
+        elif event.type == pygame.QUIT:
             pygame.quit()
             sys.exit()
         elif event.type == pygame.KEYDOWN:
@@ -467,6 +750,7 @@ def update(ctx):
             elif event.key == pygame.K_ESCAPE:
                 pygame.quit()
                 sys.exit()
+    return redraw
 
 
 # Fix for main loop in runPyGame to pass ctx instead of ctx.on_baseline
@@ -488,7 +772,26 @@ def runPyGame(
     on_cycle_complete,
     on_cycle_start,
     on_stop,
+    on_first_frame=None,
+    on_flip=None,
+    redraw_every_frame=False,
 ):
+    """Run the data collection UI until the session is stopped.
+
+    The render loop is paced to FRAME_RATE. A frame is only redrawn and
+    flipped when a stage is entered, the image or the window changed, when an
+    animation such as the rest progress bar moved, or when
+    redraw_every_frame is set. The frame timing of the session is logged
+    when the UI exits.
+
+    Stage changes are run by the loop itself, from the context's
+    StageScheduler, right before the frame that draws them. The planned,
+    entered and shown time of every transition is logged when the UI exits.
+
+    on_first_frame is called once after the first frame is shown. on_flip is
+    called right after every display flip, before any stage change can happen,
+    e.g. to timestamp the markers of a stage with the flip that presents it.
+    """
     pygame.init()
     width, height = 1000, 800
     info = pygame.display.Info()
@@ -516,16 +819,55 @@ def runPyGame(
         on_stop=on_stop,
     )
 
+    image_cache.preload(image_list, screen.get_size())
+    text_cache.preload(session_prompts(image_list))
+
     ctx.on_home_screen()
 
-    while True:
-        update(ctx)
-        current_image = (
-            ctx.image_list[ctx.image_index]
-            if ctx.image_index < len(ctx.image_list)
-            else None
-        )
-        draw(screen, ctx, current_image)
+    clock = pygame.time.Clock()
+    frame_stats = FrameStats()
+    drawn = None  # Stage entry, stage, image, window size and animation frame on screen
+
+    try:
+        while True:
+            redraw = update(ctx) or redraw_every_frame
+            render_time = None
+            now = time.monotonic()
+            ctx.scheduler.run_due(now)
+            current_image = (
+                ctx.image_list[ctx.image_index]
+                if ctx.image_index < len(ctx.image_list)
+                else None
+            )
+            frame = (
+                ctx.stage_entries,
+                ctx.current_stage,
+                current_image,
+                screen.get_size(),
+                animation_frame(screen, ctx, now),
+            )
+            if redraw or frame != drawn:
+                render_start = time.perf_counter()
+                draw(screen, ctx, current_image, now)
+                render_time = time.perf_counter() - render_start
+                ctx.scheduler.presented(time.monotonic())
+                drawn = frame
+                if on_flip is not None:
+                    on_flip()
+
+            frame_stats.frame(render_time)
+            if on_first_frame is not None:
+                on_first_frame()
+                on_first_frame = None
+            clock.tick(FRAME_RATE)
+    finally:
+        logger.info(f"Frame timing: {frame_stats.report()}")
+        logger.info(f"Stage timing: {ctx.scheduler.report()}")
+        for stage, planned, entered, presented in ctx.scheduler.transitions:
+            logger.debug(
+                f"{stage}: planned {planned:.4f}, entered +{(entered - planned) * 1000:.1f} ms, "
+                + (f"shown +{(presented - planned) * 1000:.1f} ms" if presented else "not shown")
+            )
 
 
 if __name__ == "__main__":